@@ -0,0 +1,270 @@
+# External imports
+import threading
+import time
+import numpy as np
+
+# Internal imports
+from connection import FrameDecoder
+from buffers import RingBuffer, RunningStats
+from instrumentation import metrics
+
+class AcquisitionThread(threading.Thread):
+    """
+    A class to drain a device continuously in the background, store the
+    decoded samples in a ring buffer and keep their running statistics.
+
+    Every read blocks in the device until a block of samples has arrived,
+    so the thread sleeps instead of polling while it waits.
+    """
+
+    def __init__(self, device, capacity=2**16, min_bytes=FrameDecoder.FRAME_SIZE * 16, stats_window=2**14,
+                 T=3124.0, ring=None, raw=False, latency=2, timeout=0.1):
+        """
+        Initializes the acquisition thread.
+
+        Args:
+            device (FTDI): The opened device to read from.
+            capacity (int, optional): The number of samples held in the ring buffer. Defaults to 2**16.
+            min_bytes (int, optional): The number of bytes a read waits for. Defaults to 16 frames,
+                about 5 ms of samples.
+            stats_window (int, optional): The number of recent samples in the windowed statistics,
+                None to keep no statistics. Defaults to 2**14.
+            T (float, optional): The sampling frequency. Defaults to 3124.0.
+            ring (RingBuffer, optional): The buffer to store the samples in, such as the ring of a
+                SharedStreamPublisher. Defaults to None, which creates one holding capacity samples.
+            raw (bool, optional): Store the uint16 ADC codes instead of volts. The statistics
+                are reported in volts either way. Defaults to False.
+            latency (int, optional): The latency timer of the device in milliseconds, low so a
+                partly filled transfer arrives soon. Defaults to 2.
+            timeout (float, optional): The longest wait of a read in seconds, which bounds the
+                time stop takes. Defaults to 0.1.
+        """
+        super().__init__(daemon=True)
+        self.device = device
+        self.device.configure(latency=latency, timeout=timeout)
+        self.min_bytes = min_bytes
+        self.T = T
+        self.decoder = FrameDecoder(raw)
+        dtype = np.uint16 if raw else np.float64
+        scale = FrameDecoder.VOLTS_PER_CODE if raw else 1.0
+        self.ring = RingBuffer(FrameDecoder.CHANNELS, capacity, dtype) if ring is None else ring
+        self.stats = RunningStats(FrameDecoder.CHANNELS, stats_window, scale=scale) if stats_window else None
+        self.start_time = None  # Host time of the first sample, estimated from the read times
+        self._earliest = np.inf
+        self._renewed = 0.0
+        self._new_samples = threading.Event()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        """
+        Reads, decodes and stores samples until the thread is stopped.
+        """
+        while not self._stop_event.is_set():
+            # Returns once a block has arrived or the device timeout has passed
+            with metrics.timer("read wait"):
+                data = self.device.read_block(self.min_bytes)
+            if len(data):
+                metrics.gauge("read size bytes", len(data))
+                with metrics.timer("decode"):
+                    samples = self.decoder.decode(data)
+                if samples.shape[1]:
+                    with metrics.timer("buffer"):
+                        self.ring.append(samples)
+                        if self.stats is not None:
+                            self.stats.update(samples)
+                    self._timestamp()
+                    self._new_samples.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for new samples in the ring buffer.
+
+        Args:
+            timeout (float, optional): The longest wait in seconds. Defaults to None.
+
+        Returns:
+            bool: True if new samples arrived.
+        """
+        arrived = self._new_samples.wait(timeout)
+        self._new_samples.clear()
+        return arrived
+
+    def _timestamp(self):
+        """
+        Updates the estimated host time of the first sample after a read.
+
+        The samples arrive some latency after they were taken, so the earliest
+        estimate over the recent reads is the closest one. The estimate is
+        renewed every second to follow the drift of the board clock.
+        """
+        now = time.perf_counter()
+        self._earliest = min(self._earliest, now - self.ring.count / self.T)
+        if self.start_time is None or now - self._renewed > 1.0:
+            self.start_time = self._earliest
+            self._earliest = np.inf
+            self._renewed = now
+
+    def stop(self):
+        """
+        Stops the thread and waits for it to finish.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+class MultiAcquisition(threading.Thread):
+    """
+    A class to acquire from several boards at once and merge their streams
+    into one wide set of channels.
+
+    Every device is drained by its own AcquisitionThread. This thread aligns
+    the streams on the host time of their samples, estimated from the sample
+    counters and the read times, and appends the samples taken at the same
+    time to one ring buffer, board after board. When the board clocks drift
+    apart, samples of the lagging stream are skipped or repeated. The host
+    times jitter from read to read, so only the averaged misalignment is
+    corrected, once it exceeds a few samples.
+    """
+
+    def __init__(self, devices, capacity=2**16, min_bytes=FrameDecoder.FRAME_SIZE * 16, stats_window=2**14,
+                 T=3124.0, tolerance=4.0, smoothing=0.005, ring=None, raw=False):
+        """
+        Initializes the acquisition threads.
+
+        Args:
+            devices (list): The opened devices to read from.
+            capacity (int, optional): The number of samples held in the ring buffers. Defaults to 2**16.
+            min_bytes (int, optional): The number of bytes a read of a board waits for. Defaults to 16 frames.
+            stats_window (int, optional): The number of recent samples in the windowed statistics. Defaults to 2**14.
+            T (float, optional): The sampling frequency of the boards. Defaults to 3124.0.
+            tolerance (float, optional): The averaged misalignment in samples after which the
+                boards are realigned by skipping or repeating samples. Defaults to 4.0.
+            smoothing (float, optional): The weight of the latest misalignment in its average,
+                applied at every merge. Defaults to 0.005, about a second at 16 frames per read.
+            ring (RingBuffer, optional): The buffer to store the merged samples in. Defaults to None,
+                which creates one holding capacity samples.
+            raw (bool, optional): Store the uint16 ADC codes instead of volts. Defaults to False.
+        """
+        super().__init__(daemon=True)
+        self.devices = devices
+        self.T = T
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.workers = [AcquisitionThread(device, capacity, min_bytes, stats_window=None, T=T, raw=raw)
+                        for device in devices]
+        self.channels = FrameDecoder.CHANNELS * len(devices)
+        dtype = np.uint16 if raw else np.float64
+        scale = FrameDecoder.VOLTS_PER_CODE if raw else 1.0
+        self.ring = RingBuffer(self.channels, capacity, dtype) if ring is None else ring
+        self.stats = RunningStats(self.channels, stats_window, scale=scale)
+        self.positions = None  # Sample count of every board at the next merged sample
+        self._drift = None  # Averaged misalignment of every board in samples
+        self._realigning = None  # Boards being moved back to the first board
+        self.dropped = 0  # Merged samples lost because a board buffer overflowed
+        self._new_samples = threading.Event()
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """
+        Starts the acquisition threads and the merging.
+        """
+        for worker in self.workers:
+            worker.start()
+        super().start()
+
+    def run(self):
+        """
+        Merges the streams until the thread is stopped.
+        """
+        while not self._stop_event.is_set():
+            # Merge whenever the first board delivered a block
+            if self.workers[0].wait(0.1):
+                while self._merge():
+                    self._new_samples.set()
+
+    def _align(self):
+        """
+        Chooses the first samples of the boards taken at the same time, as early as they are still held.
+        """
+        starts = [worker.start_time for worker in self.workers]
+        counts = [worker.ring.count for worker in self.workers]
+        oldest = max(start + (count - worker.ring.size) / self.T
+                     for start, count, worker in zip(starts, counts, self.workers))
+        self.positions = [min(max(round((oldest - start) * self.T), count - worker.ring.size), count)
+                          for start, count, worker in zip(starts, counts, self.workers)]
+        self._drift = np.zeros(len(self.workers))
+        self._realigning = np.zeros(len(self.workers), dtype=bool)
+
+    def _correct_drift(self):
+        """
+        Skips or repeats a sample of the boards that drifted away from the first board.
+
+        Once the averaged misalignment of a board exceeds the tolerance, one
+        sample is corrected per merge until the board is within half a sample.
+        """
+        reference = self.workers[0].start_time
+        for i, worker in enumerate(self.workers[1:], 1):
+            error = self.positions[i] - self.positions[0] - (reference - worker.start_time) * self.T
+            self._drift[i] += self.smoothing * (error - self._drift[i])
+            if abs(self._drift[i]) > self.tolerance:
+                self._realigning[i] = True
+            if self._realigning[i]:
+                step = 1 if self._drift[i] > 0 else -1
+                self.positions[i] -= step
+                self._drift[i] -= step
+                self._realigning[i] = abs(self._drift[i]) > 0.5
+
+    def _merge(self):
+        """
+        Moves the samples available from every board to the merged buffer.
+
+        Returns:
+            bool: Whether any samples were merged.
+        """
+        if any(worker.start_time is None for worker in self.workers):
+            return False
+        if self.positions is None:
+            self._align()
+        self._correct_drift()
+        available = min(worker.ring.count - position for worker, position in zip(self.workers, self.positions))
+        if available <= 0:
+            return False
+        blocks = []
+        for i, worker in enumerate(self.workers):
+            samples, self.positions[i], dropped = worker.ring.read(self.positions[i], self.positions[i] + available)
+            if dropped:
+                # The boards are no longer aligned, start again from the held samples
+                self.dropped += available
+                metrics.count("samples dropped", available)
+                self.positions = None
+                return False
+            blocks.append(samples)
+        with metrics.timer("merge"):
+            samples = np.concatenate(blocks)
+            self.ring.append(samples)
+            self.stats.update(samples)
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Waits for new merged samples in the ring buffer.
+
+        Args:
+            timeout (float, optional): The longest wait in seconds. Defaults to None.
+
+        Returns:
+            bool: True if new samples arrived.
+        """
+        arrived = self._new_samples.wait(timeout)
+        self._new_samples.clear()
+        return arrived
+
+    def stop(self):
+        """
+        Stops the merging and the acquisition threads and waits for them to finish.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        for worker in self.workers:
+            worker.stop()
@@ -0,0 +1,117 @@
+# Headless reconstruction of every recording in the readings directory
+
+# External imports
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+# Internal imports
+from config.path_config import *
+from config.settings import Settings
+from file_handler import Recording, Recording_Writer
+
+CHUNK_SIZE = 2**16  # Samples reconstructed at once
+
+def find_recordings(readings_dir):
+    """
+    Finds the folders in the readings directory that contain a response.
+
+    Args:
+        readings_dir (str): The readings directory.
+
+    Returns:
+        list: The paths of the recording folders.
+    """
+    folders = []
+    for name in sorted(os.listdir(readings_dir)):
+        folder = os.path.join(readings_dir, name)
+        if os.path.exists(folder + "/output.bin") or os.path.exists(folder + "/output.csv"):
+            folders.append(folder)
+    return folders
+
+def _inputs(folder):
+    """
+    Lists the files the reconstruction of a recording depends on.
+
+    Args:
+        folder (str): The recording folder.
+
+    Returns:
+        list: The existing input files.
+    """
+    names = ["output.bin", "output.json", "output.csv", CONFIGURATION_FILE, CALIBRATION_FILE]
+    return [folder + "/" + name for name in names if os.path.exists(folder + "/" + name)]
+
+def is_up_to_date(folder):
+    """
+    Checks whether the reconstruction is newer than the response and the configuration.
+
+    Args:
+        folder (str): The recording folder.
+
+    Returns:
+        bool: True if the reconstruction does not need to be redone.
+    """
+    if not os.path.exists(folder + "/reconstruction.bin"):
+        return False
+    modified = os.path.getmtime(folder + "/reconstruction.bin")
+    return all(os.path.getmtime(path) <= modified for path in _inputs(folder))
+
+def reconstruct_recording(folder, threads=1):
+    """
+    Reconstructs the force on every channel of a recording and saves it.
+
+    The settings saved with the recording are used. The result is written
+    under a temporary name first, so an interrupted run never looks up to date.
+
+    Args:
+        folder (str): The recording folder.
+        threads (int, optional): The number of threads filtering blocks of
+            the recording in parallel. Defaults to 1.
+
+    Returns:
+        str: The recording folder.
+    """
+    # The files saved with the recording, or the current ones if they are missing
+    settings = Settings(folder, fallback=CONFIG_PATH)
+
+    recording = Recording(folder + "/output")
+    channels = recording.shape[0]
+    offsets = settings.calibration.vectors(channels)[0]
+
+    reconstructor = settings.reconstructor()
+    writer = Recording_Writer(folder + "/reconstruction.partial", channels, settings.setup.T, block_size=CHUNK_SIZE)
+    for chunk in recording.iter_chunks(CHUNK_SIZE * threads):
+        if threads > 1:
+            writer.write(reconstructor.process_parallel(chunk - offsets, workers=threads))
+        else:
+            writer.write(reconstructor.process(chunk - offsets))
+    writer.close()
+    os.replace(folder + "/reconstruction.partial.json", folder + "/reconstruction.json")
+    os.replace(folder + "/reconstruction.partial.bin", folder + "/reconstruction.bin")
+    return folder
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstruct the force for every recording in the readings directory.")
+    parser.add_argument("names", nargs="*", help="names of the recordings to reconstruct, all by default")
+    parser.add_argument("--readings-dir", default=READINGS_DIR, help="directory with the recording folders")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, all cores by default")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="threads splitting each recording into blocks reconstructed in parallel")
+    parser.add_argument("--force", action="store_true", help="reconstruct recordings that are already up to date")
+    args = parser.parse_args()
+
+    folders = find_recordings(args.readings_dir)
+    if args.names:
+        folders = [folder for folder in folders if os.path.basename(folder) in args.names]
+    pending = [folder for folder in folders if args.force or not is_up_to_date(folder)]
+    print(f"{len(pending)} of {len(folders)} recordings to reconstruct")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(reconstruct_recording, folder, args.threads): folder for folder in pending}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except Exception as error:
+                tqdm.write(f"Failed to reconstruct {futures[future]}: {error}")
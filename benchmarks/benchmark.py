@@ -0,0 +1,293 @@
+# Benchmarks of the acquisition, decoding, reconstruction, storage and plotting hot paths
+
+# External imports
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from scipy import signal
+
+# Run from the repository root, where the configuration and readings paths are relative to
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+# Internal imports
+from config.path_config import *
+from config.settings import settings
+from connection import FTDI, FrameDecoder, process_FTDI_readings
+from file_handler import Data_Handler, Recording, read_recording
+from reconstruction import Reconstructor
+from replay import ReplayDevice, Synthetic_Signal, encode_frames
+
+BASELINE_FILE = os.path.join(ROOT, "benchmarks", "baseline.json")
+T = 3124.0  # Sampling frequency of the board
+CHUNK_SAMPLES = [4, 32, 256, 2048]  # Samples per read, 4 is about one 1 ms timer tick
+
+def measure(function, samples, setup=None, min_time=0.5, max_calls=2000):
+    """
+    Times repeated calls of a function.
+
+    Args:
+        function (callable): The function to time.
+        samples (int): The number of samples processed per call.
+        setup (callable, optional): A function called untimed before every call. Defaults to None.
+        min_time (float, optional): The least total time spent in the calls. Defaults to 0.5.
+        max_calls (int, optional): The most calls made. Defaults to 2000.
+
+    Returns:
+        dict: The throughput in samples per second and the latency percentiles in milliseconds.
+    """
+    times = []
+    while sum(times) < min_time and len(times) < max_calls:
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {
+        "samples/s": samples * len(times) / times.sum(),
+        "p50 ms": np.percentile(times, 50) * 1e3,
+        "p90 ms": np.percentile(times, 90) * 1e3,
+        "p99 ms": np.percentile(times, 99) * 1e3,
+    }
+
+def synthetic_bytes(samples):
+    """
+    Creates a framed byte stream of a synthetic signal.
+
+    Args:
+        samples (int): The number of samples per channel.
+
+    Returns:
+        numpy.ndarray: The framed bytes.
+    """
+    return encode_frames(Synthetic_Signal(T).generate(samples))
+
+class Bytes_Device():
+    """
+    A class standing in for the ftd2xx device handle, returning a fixed block of bytes.
+    """
+
+    def __init__(self, data):
+        self.data = data.tobytes()
+
+    def getQueueStatus(self):
+        return len(self.data)
+
+    def read(self, count):
+        return self.data[:count]
+
+def original_read(device):
+    """
+    Reads the device as the acquisition did before the benchmarks, byte by byte into a list.
+
+    Kept as the reference the array reads are compared with.
+
+    Args:
+        device (Bytes_Device): The device handle.
+
+    Returns:
+        list: The data read from the device.
+    """
+    read = device.read(device.getQueueStatus())
+    data = []
+    for char in read:
+        data.append(char)
+    return data
+
+def original_process_FTDI_readings(Obuff):
+    """
+    Decodes a buffer as the acquisition did before the benchmarks, searching the start sequence
+    in every call.
+
+    Kept as the reference the FrameDecoder is compared with.
+
+    Args:
+        Obuff (numpy.ndarray): The buffer of readings from the FTDI device.
+
+    Returns:
+        numpy.ndarray: The readings of the 16 channels in volts.
+    """
+    ind = np.where(Obuff == 0)[0]
+    for i in range(len(ind) - 100):
+        if (Obuff[ind[i]] == 0 and Obuff[ind[i] + 3] == 16 and
+            Obuff[ind[i] + 6] == 32 and Obuff[ind[i] + 9] == 1):
+            break
+    Obuff = np.delete(Obuff, slice(0, ind[i]))
+    Obuff = Obuff.astype(np.uint16)
+    if len(Obuff[4::9] << 8) == len(Obuff[5::9]):
+        Ocode1 = (Obuff[4::9] << 8) + Obuff[5::9]
+    else:
+        Ocode1 = (Obuff[4::9] << 8)[:-1] + Obuff[5::9]
+    Ocode1 = Ocode1[:-(len(Ocode1) % 16)]
+    result = np.reshape(Ocode1, (16, int(len(Ocode1) / 16)), order='F') * 3.3 / 4096
+    result = np.roll(result, -2, axis=0)
+    return result
+
+def bench_read():
+    """
+    Benchmarks the conversion of a device read into an array.
+    """
+    results = {}
+    for samples in CHUNK_SAMPLES:
+        sensor = FTDI.__new__(FTDI)
+        sensor.device = Bytes_Device(synthetic_bytes(samples))
+        out = np.empty(samples * FrameDecoder.FRAME_SIZE, dtype=np.uint8)
+        results[f"original read {samples}"] = measure(lambda: original_read(sensor.device), samples)
+        results[f"FTDI.read {samples}"] = measure(sensor.read, samples)
+        results[f"FTDI.read out= {samples}"] = measure(lambda: sensor.read(out), samples)
+    return results
+
+def bench_decode():
+    """
+    Benchmarks decoding the byte stream across chunk sizes.
+    """
+    results = {}
+    for samples in CHUNK_SAMPLES:
+        chunk = synthetic_bytes(samples)
+        # The original decoder took the bytes of every read as an integer array, and returns
+        # nothing for whole frames only, so it gets the partial frame a real read ends with
+        readings = synthetic_bytes(samples + 1)[:-FrameDecoder.PACKET_SIZE].astype(int)
+        results[f"original process_FTDI_readings {samples}"] = measure(
+            lambda: original_process_FTDI_readings(readings), samples)
+        results[f"process_FTDI_readings {samples}"] = measure(lambda: process_FTDI_readings(chunk), samples)
+        decoder = FrameDecoder()
+        results[f"FrameDecoder.decode {samples}"] = measure(lambda: decoder.decode(chunk), samples)
+        raw_decoder = FrameDecoder(raw=True)
+        results[f"FrameDecoder.decode raw {samples}"] = measure(lambda: raw_decoder.decode(chunk), samples)
+    return results
+
+def bench_reconstruction(system):
+    """
+    Benchmarks reconstructing the force with lsim and with the Reconstructor.
+
+    Args:
+        system (scipy.signal.lti): The sensor system.
+    """
+    results = {}
+    rng = np.random.default_rng(0)
+    for samples in CHUNK_SAMPLES:
+        chunk = rng.normal(0, 0.01, (FrameDecoder.CHANNELS, samples))
+        t = np.arange(samples) / T
+        results[f"lsim 1 channel {samples}"] = measure(lambda: signal.lsim(system, chunk[0], t, 0), samples)
+        reconstructor = Reconstructor(system, T)
+        results[f"Reconstructor 16 channels {samples}"] = measure(lambda: reconstructor.process(chunk), samples)
+    data = rng.normal(0, 0.01, int(60 * T))
+    results["lsim 1 channel 60 s"] = measure(lambda: signal.lsim(system, data, np.arange(len(data)) / T, 0), len(data), max_calls=5)
+    results["Reconstructor 1 channel 60 s"] = measure(lambda: Reconstructor(system, T).process(data), len(data), max_calls=20)
+    results["Reconstructor parallel 1 channel 60 s"] = measure(lambda: Reconstructor(system, T).process_parallel(data), len(data), max_calls=20)
+    return results
+
+def bench_storage():
+    """
+    Benchmarks saving and loading a 60 s recording of 16 channels.
+
+    The CSV cases are the format recordings were originally saved in.
+    """
+    results = {}
+    response = np.random.default_rng(0).random((int(60 * T), FrameDecoder.CHANNELS))
+    # Write to a temporary readings directory, leaving the real recordings and their catalog alone
+    with tempfile.TemporaryDirectory() as readings_dir:
+        DH = Data_Handler("_benchmark", response, readings_dir)
+        path = DH.newpath + "/output"
+        for file_format in ["binary", "csv"]:
+            calls = 20 if file_format == "binary" else 2
+            results[f"save_response {file_format}"] = measure(lambda: DH.save_response(file_format), len(response), max_calls=calls)
+            results[f"read_recording {file_format}"] = measure(lambda: read_recording(path), len(response), max_calls=calls)
+            os.remove(path + (".bin" if file_format == "binary" else ".csv"))
+        DH.save_response()
+        results["Recording open and read 1 s"] = measure(lambda: Recording(path)[12, :int(T)], int(T))
+        # Raw ADC codes, a quarter of the size
+        DH.response = np.round(response / FrameDecoder.VOLTS_PER_CODE).astype(np.uint16)
+        results["save_response binary raw"] = measure(DH.save_response, len(response), max_calls=20)
+        results["read_recording binary raw"] = measure(lambda: read_recording(path), len(response), max_calls=20)
+    return results
+
+def bench_gui():
+    """
+    Benchmarks the live window updates on the offscreen Qt platform.
+    """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        from PyQt6.QtWidgets import QApplication
+        from live_class_all_lsim import MyWindow
+        from acquisition import AcquisitionThread
+    except ImportError as error:
+        print(f"Skipping the GUI benchmarks: {error}")
+        return {}
+    app = QApplication.instance() or QApplication(sys.argv)
+    results = {}
+    for reconstruct, name in [(0, "update_plot"), (1, "update_reconstruct_plot")]:
+        window = MyWindow(reconstruct)
+        # Feed the ring buffer directly, without starting the acquisition thread
+        window.sensors = [ReplayDevice()]
+        window.acquisition = AcquisitionThread(window.sensors[0])
+        window.additional_channels = [1, 2]
+        update = getattr(window, name)
+        for roll in [10000, 400000]:
+            window.spin_box_roll.setValue(roll)
+            for samples in [4, 256]:
+                chunk = FrameDecoder().decode(synthetic_bytes(samples + 1))[:, :samples]
+                # Fill the window first, so the whole roll duration is drawn
+                for i in range(0, roll, 2048):
+                    window.acquisition.ring.append(np.repeat(chunk[:, :1], 2048, axis=1))
+                    update()
+                results[f"{name} roll {roll} {samples}"] = measure(update, samples, setup=lambda: window.acquisition.ring.append(chunk), max_calls=300)
+        window.close()
+    return results
+
+def print_results(results, baseline=None):
+    """
+    Prints the results as a table, with the change against the baseline if given.
+
+    Args:
+        results (dict): The benchmark results.
+        baseline (dict, optional): The baseline results. Defaults to None.
+    """
+    print(f"{'benchmark':45s} {'samples/s':>12s} {'p50 ms':>9s} {'p90 ms':>9s} {'p99 ms':>9s} {'vs baseline':>12s}")
+    for name, result in results.items():
+        line = f"{name:45s} {result['samples/s']:12.4g} {result['p50 ms']:9.4f} {result['p90 ms']:9.4f} {result['p99 ms']:9.4f}"
+        if baseline is not None and name in baseline:
+            line += f" {result['samples/s'] / baseline[name]['samples/s']:11.2f}x"
+        print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the piezoelectric pipeline hot paths.")
+    parser.add_argument("--only", nargs="+", choices=["read", "decode", "reconstruction", "storage", "gui"],
+                        help="run only the selected groups")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    # Create the sensor system from the configuration
+    system = settings.system
+
+    groups = {
+        "read": bench_read,
+        "decode": bench_decode,
+        "reconstruction": lambda: bench_reconstruction(system),
+        "storage": bench_storage,
+        "gui": bench_gui,
+    }
+    results = {}
+    for group in args.only or groups:
+        results.update(groups[group]())
+
+    baseline = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as json_file:
+            baseline = json.load(json_file)
+    print(f"Real-time rate: {T:.0f} samples/s per channel")
+    print_results(results, baseline)
+
+    if args.save:
+        if baseline is not None:
+            baseline.update(results)
+            results = baseline
+        with open(BASELINE_FILE, 'w') as json_file:
+            json.dump(results, json_file, indent=4)
+        print(f"Saved the baseline to {BASELINE_FILE}")
@@ -0,0 +1,288 @@
+# External imports
+import threading
+import numpy as np
+
+class RingBuffer():
+    """
+    A class to hold the most recent samples of a multi-channel stream in
+    preallocated memory.
+
+    Every sample is stored twice, half a buffer apart, so the latest samples
+    are always available as one contiguous view. A single writer and any
+    number of readers can share the buffer without locks: the writer copies
+    the samples first and only then advances the sample counter.
+    """
+
+    def __init__(self, channels, capacity, dtype=np.float64):
+        """
+        Initializes the ring buffer.
+
+        Args:
+            channels (int): The number of channels.
+            capacity (int): The number of samples held per channel.
+            dtype (numpy.dtype, optional): The type of the samples. Defaults to numpy.float64.
+        """
+        self.channels = channels
+        self.capacity = capacity
+        self.data = np.zeros((channels, 2 * capacity), dtype=dtype)
+        self.size = 0  # Number of valid samples held
+        self.count = 0  # Total number of samples written
+
+    def append(self, samples):
+        """
+        Appends samples to the buffer, overwriting the oldest ones.
+
+        Args:
+            samples (numpy.ndarray): The samples to append, shaped (channels, samples).
+        """
+        length = np.size(samples, 1)
+        # Only the newest samples fit if the chunk is larger than the buffer
+        samples = samples[:, -self.capacity:]
+        start = (self.count + length - np.size(samples, 1)) % self.capacity
+        first = min(np.size(samples, 1), self.capacity - start)
+        rest = np.size(samples, 1) - first
+        for offset in (0, self.capacity):
+            self.data[:, offset + start:offset + start + first] = samples[:, :first]
+            self.data[:, offset:offset + rest] = samples[:, first:]
+        # Publish the samples only once they have been copied
+        self.size = min(self.size + length, self.capacity)
+        self.count += length
+
+    def latest(self, length):
+        """
+        Returns a view of the most recent samples.
+
+        Args:
+            length (int): The number of samples requested.
+
+        Returns:
+            numpy.ndarray: The latest samples, shaped (channels, min(length, available)).
+        """
+        length = min(length, self.size)
+        end = self.count % self.capacity + self.capacity
+        return self.data[:, end - length:end]
+
+    def read(self, since, until=None):
+        """
+        Copies the samples written after a given sample count.
+
+        Args:
+            since (int): The sample count returned by the previous read.
+            until (int, optional): The sample count to stop at. Defaults to None,
+                which reads up to the current sample count.
+
+        Returns:
+            tuple: The new samples shaped (channels, samples), the sample count
+                read up to and the number of samples that were overwritten
+                before they could be read.
+        """
+        count = self.count if until is None else min(until, self.count)
+        length = count - since
+        dropped = min(max(self.count - since - self.size, 0), length)
+        end = count % self.capacity + self.capacity
+        samples = self.data[:, end - length + dropped:end].copy()
+        return samples, count, dropped
+
+    def resize(self, capacity):
+        """
+        Changes the capacity of the buffer, keeping the most recent samples.
+
+        The buffer must not be written to while it is being resized.
+
+        Args:
+            capacity (int): The new number of samples held per channel.
+        """
+        samples = self.latest(capacity)
+        count = self.count
+        self.capacity = capacity
+        self.data = np.zeros((self.channels, 2 * capacity), dtype=self.data.dtype)
+        # Place the kept samples so that the sample count stays unchanged
+        self.size = 0
+        self.count = count - np.size(samples, 1)
+        self.append(samples)
+
+    def clear(self):
+        """
+        Discards all samples held in the buffer.
+        """
+        self.data[:] = 0
+        self.size = 0
+        self.count = 0
+
+class RunningStats():
+    """
+    A class to keep the mean, variance, minimum and maximum of every channel
+    of a stream, both since the last reset and over a recent window.
+
+    The window is kept as sums, minima and maxima of consecutive blocks of
+    samples, so reading the windowed statistics only passes over the block
+    summaries and never over the samples. The sums are taken relative to the
+    first sample of every channel to avoid cancellation in the variance.
+
+    Updating and reading are locked against each other, so an acquisition
+    thread can update the statistics while another thread reads them.
+    """
+
+    def __init__(self, channels, window, block=256, scale=1.0):
+        """
+        Initializes the statistics.
+
+        Args:
+            channels (int): The number of channels.
+            window (int): The number of recent samples in the windowed statistics,
+                rounded up to whole blocks.
+            block (int, optional): The number of samples summarized together. Defaults to 256.
+            scale (float, optional): The factor applied to the reported statistics, such as the
+                volts per ADC code for raw samples. Defaults to 1.0.
+        """
+        self.channels = channels
+        self.block = block
+        self.scale = scale
+        self.blocks = max(1, -(-window // block))
+        self.window = self.blocks * block
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all samples.
+        """
+        with self.lock:
+            self.shift = np.zeros((self.channels, 1))  # First sample of every channel
+            self.count = 0  # Samples seen since the reset
+            self.total = np.zeros(self.channels)
+            self.squares = np.zeros(self.channels)
+            self.low = np.full(self.channels, np.inf)
+            self.high = np.full(self.channels, -np.inf)
+            # Summaries of the completed blocks, interleaved as sum, sum of squares, minimum and maximum
+            self.summaries = RingBuffer(4 * self.channels, self.blocks)
+            self.partial = np.empty((self.channels, 0))  # Samples of the block being filled
+
+    def update(self, samples):
+        """
+        Adds new samples to the statistics.
+
+        Args:
+            samples (numpy.ndarray): The new samples, shaped (channels, samples).
+        """
+        length = np.size(samples, 1)
+        if length == 0:
+            return
+        with self.lock:
+            if self.count == 0:
+                self.shift = samples[:, :1].astype(np.float64)
+            samples = samples - self.shift
+            self.total = self.total + samples.sum(axis=1)
+            self.squares = self.squares + np.square(samples).sum(axis=1)
+            self.low = np.minimum(self.low, samples.min(axis=1))
+            self.high = np.maximum(self.high, samples.max(axis=1))
+
+            samples = np.concatenate((self.partial, samples), axis=1)
+            complete = np.size(samples, 1) // self.block
+            if complete:
+                blocks = samples[:, :complete * self.block].reshape(self.channels, complete, self.block)
+                self.summaries.append(np.concatenate((blocks.sum(axis=2), np.square(blocks).sum(axis=2),
+                                                      blocks.min(axis=2), blocks.max(axis=2))))
+            self.partial = samples[:, complete * self.block:]
+            self.count += length
+
+    def _window(self):
+        """
+        Sums up the block summaries and the partial block of the window.
+
+        Returns:
+            tuple: The number of samples, the sums, the sums of squares, the minima and the maxima.
+        """
+        total, squares, low, high = np.split(self.summaries.latest(self.blocks), 4)
+        partial = self.partial
+        count = np.size(total, 1) * self.block + np.size(partial, 1)
+        return (count, total.sum(axis=1) + partial.sum(axis=1), squares.sum(axis=1) + np.square(partial).sum(axis=1),
+                np.minimum(low.min(axis=1, initial=np.inf), partial.min(axis=1, initial=np.inf)),
+                np.maximum(high.max(axis=1, initial=-np.inf), partial.max(axis=1, initial=-np.inf)))
+
+    def _stats(self, window):
+        """
+        Returns the sums the statistics are computed from, taken together under the lock.
+
+        Args:
+            window (bool): Whether to use the recent window instead of all samples since the reset.
+
+        Returns:
+            tuple: The number of samples, the sums, the sums of squares, the minima, the maxima
+                and the first sample of every channel the sums are relative to.
+        """
+        with self.lock:
+            if window:
+                return self._window() + (self.shift,)
+            return self.count, self.total, self.squares, self.low, self.high, self.shift
+
+    def mean(self, window=True):
+        """
+        Returns the mean of every channel.
+
+        Args:
+            window (bool, optional): Whether to use the recent window instead of all
+                samples since the reset. Defaults to True.
+
+        Returns:
+            numpy.ndarray: The means, NaN before any sample.
+        """
+        count, total, _, _, _, shift = self._stats(window)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (total / count + shift[:, 0]) * self.scale
+
+    def var(self, window=True):
+        """
+        Returns the variance of every channel.
+
+        Args:
+            window (bool, optional): Whether to use the recent window instead of all
+                samples since the reset. Defaults to True.
+
+        Returns:
+            numpy.ndarray: The variances, NaN before any sample.
+        """
+        count, total, squares = self._stats(window)[:3]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.maximum(squares / count - np.square(total / count), 0) * self.scale**2
+
+    def std(self, window=True):
+        """
+        Returns the standard deviation of every channel, the noise of an idle sensor.
+
+        Args:
+            window (bool, optional): Whether to use the recent window instead of all
+                samples since the reset. Defaults to True.
+
+        Returns:
+            numpy.ndarray: The standard deviations, NaN before any sample.
+        """
+        return np.sqrt(self.var(window))
+
+    def min(self, window=True):
+        """
+        Returns the minimum of every channel.
+
+        Args:
+            window (bool, optional): Whether to use the recent window instead of all
+                samples since the reset. Defaults to True.
+
+        Returns:
+            numpy.ndarray: The minima, infinite before any sample.
+        """
+        stats = self._stats(window)
+        return (stats[3] + stats[5][:, 0]) * self.scale
+
+    def max(self, window=True):
+        """
+        Returns the maximum of every channel.
+
+        Args:
+            window (bool, optional): Whether to use the recent window instead of all
+                samples since the reset. Defaults to True.
+
+        Returns:
+            numpy.ndarray: The maxima, negative infinite before any sample.
+        """
+        stats = self._stats(window)
+        return (stats[4] + stats[5][:, 0]) * self.scale
@@ -0,0 +1,372 @@
+# Searchable index of the recordings in the readings directory
+
+# External imports
+import argparse
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import hashlib
+import json
+import os
+import sqlite3
+import numpy as np
+
+# Internal imports
+from config.path_config import *
+
+CATALOG_FILE = "catalog.sqlite"  # Name of the index in the readings directory
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    name TEXT PRIMARY KEY,
+    timestamp TEXT,
+    duration REAL,
+    T REAL,
+    channels INTEGER,
+    samples INTEGER,
+    dtype TEXT,
+    description TEXT,
+    size INTEGER,
+    files TEXT,
+    config_hash TEXT,
+    calibration_hash TEXT,
+    modified REAL
+);
+CREATE INDEX IF NOT EXISTS recordings_timestamp ON recordings (timestamp);
+CREATE INDEX IF NOT EXISTS recordings_duration ON recordings (duration);
+CREATE INDEX IF NOT EXISTS recordings_config_hash ON recordings (config_hash);
+CREATE INDEX IF NOT EXISTS recordings_calibration_hash ON recordings (calibration_hash);
+CREATE TABLE IF NOT EXISTS names (
+    name TEXT PRIMARY KEY,
+    next INTEGER
+);
+"""
+
+COLUMNS = ("name", "timestamp", "duration", "T", "channels", "samples", "dtype", "description", "size", "files",
+           "config_hash", "calibration_hash", "modified")
+
+class Catalog():
+    """
+    A class to keep an index of the recordings in the readings directory.
+
+    The index is an SQLite database next to the recording folders. Data_Handler
+    updates the entry of a recording in finish_recording and save_metadata
+    only, and rebuild indexes the folders changed without it, so past
+    experiments are found by name, date, duration, sampling frequency,
+    description or configuration without opening their folders. The catalog
+    also hands out unique recording names from a counter kept per name.
+    """
+
+    def __init__(self, readings_dir=READINGS_DIR):
+        """
+        Opens the catalog of a readings directory, creating it if needed.
+
+        Args:
+            readings_dir (str, optional): The readings directory. Defaults to READINGS_DIR.
+        """
+        os.makedirs(readings_dir, exist_ok=True)
+        self.readings_dir = readings_dir
+        # Transactions are opened explicitly, so several processes can share the catalog
+        self.connection = sqlite3.connect(os.path.join(readings_dir, CATALOG_FILE), timeout=10.0,
+                                          isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        """
+        Returns the number of indexed recordings.
+        """
+        return self.connection.execute("SELECT COUNT(*) FROM recordings").fetchone()[0]
+
+    def __contains__(self, name):
+        """
+        Checks whether a recording is indexed.
+        """
+        return self.connection.execute("SELECT 1 FROM recordings WHERE name = ?", (name,)).fetchone() is not None
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Runs the enclosed statements as one transaction, locking out other writers.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def allocate(self, name):
+        """
+        Returns an unused recording name, appending a number if the name is taken.
+
+        The next number for every name is stored, so a name is found without
+        probing the folders one by one. Folders created without the catalog
+        are still skipped.
+
+        Args:
+            name (str): The requested name.
+
+        Returns:
+            str: The name itself if it is free, otherwise the name followed by the next free number.
+        """
+        with self._transaction():
+            row = self.connection.execute("SELECT next FROM names WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                candidate, number = name, 2
+            else:
+                candidate, number = name + str(row["next"]), row["next"] + 1
+            while os.path.exists(os.path.join(self.readings_dir, candidate)):
+                candidate, number = name + str(number), number + 1
+            self.connection.execute("INSERT OR REPLACE INTO names (name, next) VALUES (?, ?)", (name, number))
+        return candidate
+
+    def _describe(self, name):
+        """
+        Collects the catalog entry of a recording folder.
+
+        Args:
+            name (str): The name of the recording.
+
+        Returns:
+            dict: The values of the catalog columns.
+        """
+        folder = os.path.join(self.readings_dir, name)
+        files = {}
+        modified = os.path.getmtime(folder)
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                status = entry.stat()
+                files[entry.name] = status.st_size
+                modified = max(modified, status.st_mtime)
+
+        metadata = _load_json(os.path.join(folder, "metadata.json")) or {}
+        header = _load_json(os.path.join(folder, "output.json"))
+        T = samples = channels = dtype = None
+        if header is not None:
+            T = header["T"]
+            channels = header["shape"][1]
+            dtype = header["dtype"]
+            # Take the number of samples from the file size, in case the recording was interrupted
+            samples = files.get("output.bin", 0) // (np.dtype(dtype).itemsize * channels)
+        elif "sampling frequency" in metadata:
+            T = float(metadata["sampling frequency"].removesuffix("Hz"))
+        if samples is not None and T:
+            duration = samples / T
+        elif "length of signal" in metadata:
+            duration = float(metadata["length of signal"].split()[0])
+        else:
+            duration = None
+
+        if "date and time" in metadata:
+            timestamp = datetime.strptime(metadata["date and time"], "%Y-%m-%d_%H-%M-%S")
+        else:
+            timestamp = datetime.fromtimestamp(modified).replace(microsecond=0)
+
+        return {
+            "name": name,
+            "timestamp": timestamp.isoformat(" "),
+            "duration": duration,
+            "T": T,
+            "channels": channels,
+            "samples": samples,
+            "dtype": dtype,
+            "description": metadata.get("description"),
+            "size": sum(files.values()),
+            "files": json.dumps(files),
+            "config_hash": _hash_file(os.path.join(folder, CONFIGURATION_FILE)),
+            "calibration_hash": _hash_file(os.path.join(folder, CALIBRATION_FILE)),
+            "modified": modified,
+        }
+
+    def update(self, name):
+        """
+        Indexes a recording folder again, after files were saved in it.
+
+        Args:
+            name (str): The name of the recording.
+        """
+        entry = self._describe(name)
+        self.connection.execute(f"INSERT OR REPLACE INTO recordings ({', '.join(COLUMNS)}) "
+                                f"VALUES ({', '.join('?' * len(COLUMNS))})", [entry[column] for column in COLUMNS])
+
+    def remove(self, name):
+        """
+        Removes a recording from the index. Its folder is left untouched.
+
+        Args:
+            name (str): The name of the recording.
+        """
+        self.connection.execute("DELETE FROM recordings WHERE name = ?", (name,))
+
+    def get(self, name):
+        """
+        Returns the catalog entry of a recording.
+
+        Args:
+            name (str): The name of the recording.
+
+        Returns:
+            dict: The entry, None if the recording is not indexed.
+        """
+        row = self.connection.execute("SELECT * FROM recordings WHERE name = ?", (name,)).fetchone()
+        return None if row is None else _entry(row)
+
+    def find(self, name=None, description=None, since=None, until=None, min_duration=None, max_duration=None,
+             T=None, channels=None, config_hash=None, calibration_hash=None, order="timestamp", limit=None):
+        """
+        Finds the recordings matching all given filters.
+
+        Args:
+            name (str, optional): Text contained in the name. Defaults to None.
+            description (str, optional): Text contained in the description. Defaults to None.
+            since (datetime or str, optional): The earliest recording time, such as "2024-05-01". Defaults to None.
+            until (datetime or str, optional): The latest recording time. A date without a time, such as
+                "2024-05-31", includes the whole day. Defaults to None.
+            min_duration (float, optional): The shortest duration in seconds. Defaults to None.
+            max_duration (float, optional): The longest duration in seconds. Defaults to None.
+            T (float, optional): The sampling frequency. Defaults to None.
+            channels (int, optional): The number of channels. Defaults to None.
+            config_hash (str, optional): The hash of the saved setup configuration. Defaults to None.
+            calibration_hash (str, optional): The hash of the saved calibration. Defaults to None.
+            order (str, optional): The column to sort by, "-" in front for descending. Defaults to "timestamp".
+            limit (int, optional): The largest number of entries returned. Defaults to None.
+
+        Returns:
+            list: The matching entries.
+        """
+        conditions, values = [], []
+        until_condition = "timestamp <= ?"
+        if isinstance(until, str) and len(until) == len("YYYY-MM-DD"):
+            until = date.fromisoformat(until)
+        if isinstance(until, date) and not isinstance(until, datetime):
+            # Compare with the start of the next day, so the recordings of the day itself are found
+            until_condition, until = "timestamp < ?", (until + timedelta(days=1)).isoformat()
+        for column, text in (("name", name), ("description", description)):
+            if text is not None:
+                conditions.append(f"{column} LIKE ? ESCAPE '\\'")
+                values.append("%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        for condition, value in (("timestamp >= ?", since), (until_condition, until),
+                                 ("duration >= ?", min_duration), ("duration <= ?", max_duration),
+                                 ("T = ?", T), ("channels = ?", channels),
+                                 ("config_hash = ?", config_hash), ("calibration_hash = ?", calibration_hash)):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value.isoformat(" ") if isinstance(value, datetime) else value)
+
+        column = order.lstrip("-")
+        if column not in COLUMNS:
+            raise ValueError(f"Unknown column '{column}'.")
+        query = "SELECT * FROM recordings"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += f" ORDER BY {column} {'DESC' if order.startswith('-') else 'ASC'}"
+        if limit is not None:
+            query += " LIMIT ?"
+            values.append(limit)
+        return [_entry(row) for row in self.connection.execute(query, values)]
+
+    def rebuild(self, full=False):
+        """
+        Brings the index up to date with the readings directory.
+
+        Only the folders modified since they were indexed are read again, and
+        the entries of removed folders are dropped.
+
+        Args:
+            full (bool, optional): Index every folder again. Defaults to False.
+
+        Returns:
+            tuple: The number of indexed and of removed recordings.
+        """
+        indexed = {row["name"]: row["modified"]
+                   for row in self.connection.execute("SELECT name, modified FROM recordings")}
+        folders = [entry for entry in os.scandir(self.readings_dir) if entry.is_dir()]
+        updated = 0
+        with self._transaction():
+            for folder in folders:
+                modified = max([folder.stat().st_mtime] + [entry.stat().st_mtime for entry in os.scandir(folder.path)
+                                                           if entry.is_file()])
+                if full or indexed.get(folder.name) != modified:
+                    self.update(folder.name)
+                    updated += 1
+            removed = indexed.keys() - {folder.name for folder in folders}
+            for name in removed:
+                self.remove(name)
+        return updated, len(removed)
+
+    def close(self):
+        """
+        Closes the catalog.
+        """
+        self.connection.close()
+
+def _load_json(path):
+    """
+    Loads a JSON file.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        dict: The content, None if the file does not exist or is incomplete.
+    """
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+def _hash_file(path):
+    """
+    Hashes the content of a file.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        str: The SHA-256 hash in hexadecimal, None if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _entry(row):
+    """
+    Converts a row of the index to an entry.
+
+    Args:
+        row (sqlite3.Row): The row.
+
+    Returns:
+        dict: The entry, with the file sizes as a dictionary.
+    """
+    entry = dict(row)
+    entry["files"] = json.loads(entry["files"])
+    return entry
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List and search the recordings in the readings directory.")
+    parser.add_argument("--readings-dir", default=READINGS_DIR, help="directory with the recording folders")
+    parser.add_argument("--rebuild", action="store_true", help="index new and changed recordings, drop removed ones")
+    parser.add_argument("--full", action="store_true", help="with --rebuild, index every recording again")
+    parser.add_argument("--name", help="only recordings whose name contains this text")
+    parser.add_argument("--description", help="only recordings whose description contains this text")
+    parser.add_argument("--since", help="only recordings made from this date on, as YYYY-MM-DD")
+    parser.add_argument("--until", help="only recordings made up to this date, included, as YYYY-MM-DD")
+    args = parser.parse_args()
+
+    with Catalog(args.readings_dir) as catalog:
+        if args.rebuild:
+            updated, removed = catalog.rebuild(args.full)
+            print(f"{updated} recordings indexed, {removed} removed")
+        for entry in catalog.find(name=args.name, description=args.description, since=args.since, until=args.until):
+            duration = "" if entry["duration"] is None else f"{entry['duration']:.1f} s"
+            print(f"{entry['timestamp']}  {entry['name']:<24} {duration:>10}  {entry['description'] or ''}")
@@ -0,0 +1,280 @@
+# Cached access to the setup configuration and the calibration
+
+# External imports
+import copy
+import os
+import stat
+import tempfile
+import threading
+from typing import NamedTuple
+import numpy as np
+import yaml
+
+# Internal imports
+from config.path_config import *
+from connection import FrameDecoder
+
+class Setup(NamedTuple):
+    """
+    The parameters of the sensor and its charge amplifier.
+    """
+
+    d33: float  # Piezoelectric constant [C/N]
+    Cf: float  # Feedback capacitance [F]
+    Rf: float  # Feedback resistance [Ohm]
+    T: float  # Sampling frequency [Hz]
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Creates the setup from the content of the configuration file.
+
+        Args:
+            data (dict): The parsed configuration file.
+
+        Returns:
+            Setup: The setup.
+        """
+        return cls(**{key: float(data[key]) for key in cls._fields})
+
+    @property
+    def c(self):
+        """
+        float: The time constant of the amplifier, Rf * Cf.
+        """
+        return self.Rf * self.Cf
+
+    @property
+    def tau(self):
+        """
+        float: The charge sensitivity of the amplifier, d33 / Cf.
+        """
+        return self.d33 / self.Cf
+
+class Calibration():
+    """
+    A class to hold the calibration of the channels, with the offsets and
+    trend lines gathered into vectors indexed by channel.
+
+    The vectors are shared by all users of the cached calibration and are
+    read-only; vectors returns copies sized to a number of channels.
+    """
+
+    def __init__(self, data):
+        """
+        Initializes the calibration.
+
+        Args:
+            data (dict): The parsed calibration file.
+        """
+        self.data = data
+        self.entries = data['channels']
+        numbers = np.array([entry["number"] for entry in self.entries], dtype=int) - 1
+        # Channels missing in the file keep zeros, for at least one board
+        size = max(FrameDecoder.CHANNELS, numbers.max() + 1 if len(numbers) else 0)
+        self.offsets = np.zeros([size, 1])
+        self.offsets[numbers, 0] = [entry['offset_mean'] for entry in self.entries]
+        self.a = np.zeros(size)
+        self.a[numbers] = [entry['a'] for entry in self.entries]
+        self.b = np.zeros(size)
+        self.b[numbers] = [entry['b'] for entry in self.entries]
+        for vector in (self.offsets, self.a, self.b):
+            vector.flags.writeable = False
+
+    def vectors(self, channels):
+        """
+        Returns the offsets, trend slopes and trend intercepts for a number of channels.
+
+        Args:
+            channels (int): The number of channels. Channels without calibration get zeros.
+
+        Returns:
+            tuple: Writable copies of the offsets shaped (channels, 1), the slopes and the intercepts.
+        """
+        n = min(channels, len(self.a))
+        offsets = np.zeros([channels, 1])
+        offsets[:n] = self.offsets[:n]
+        a = np.zeros(channels)
+        a[:n] = self.a[:n]
+        b = np.zeros(channels)
+        b[:n] = self.b[:n]
+        return offsets, a, b
+
+def write_yaml(path, data):
+    """
+    Writes a YAML file atomically.
+
+    The data is written to a temporary file in the same folder, which then
+    replaces the file, so a crash leaves either the old or the new file.
+    The file keeps its permissions.
+
+    Args:
+        path (str): The path of the file.
+        data (dict): The content.
+    """
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        # The temporary file is private, give it the permissions of the file it replaces
+        mode = stat.S_IMODE(os.stat(path).st_mode) if os.path.exists(path) else 0o644
+        os.chmod(temporary, mode)
+        with os.fdopen(descriptor, 'w') as file:
+            yaml.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+class Settings():
+    """
+    A class to hold the setup configuration and the calibration, loaded once.
+
+    Every access compares the modification time of the file with the cached
+    one and parses the file again only after it changed, so the values can
+    be read wherever they are needed. The system of the sensor and its
+    discretized filter are derived once per setup. All methods are thread-safe.
+    """
+
+    def __init__(self, config_path=CONFIG_PATH, fallback=None):
+        """
+        Initializes the settings. The files are read on first use.
+
+        Args:
+            config_path (str, optional): The folder with the configuration files. Defaults to CONFIG_PATH.
+            fallback (str, optional): The folder used for files missing in config_path, such as the
+                current configuration for a recording saved without it. Defaults to None.
+        """
+        self.config_path = config_path
+        self.fallback = fallback
+        self.lock = threading.RLock()
+        self._files = {}  # Modification time, size and parsed content of every loaded file
+        self._derived = {}  # Values derived from the setup, with the setup they belong to
+
+    def _path(self, file_name):
+        """
+        Returns the path of a configuration file.
+
+        Args:
+            file_name (str): The name of the file.
+
+        Returns:
+            str: The path in config_path, or in fallback if the file is missing there.
+        """
+        path = os.path.join(self.config_path, file_name)
+        if self.fallback is not None and not os.path.exists(path):
+            path = os.path.join(self.fallback, file_name)
+        return path
+
+    def _load(self, file_name, parse):
+        """
+        Returns the content of a file, parsing it again only if it changed.
+
+        Args:
+            file_name (str): The name of the file.
+            parse (callable): The function creating the content from the parsed YAML.
+
+        Returns:
+            The content.
+        """
+        path = self._path(file_name)
+        status = os.stat(path)
+        version = (path, status.st_mtime_ns, status.st_size)
+        with self.lock:
+            cached = self._files.get(file_name)
+            if cached is None or cached[0] != version:
+                with open(path, 'r') as file:
+                    cached = (version, parse(yaml.safe_load(file)))
+                self._files[file_name] = cached
+            return cached[1]
+
+    @property
+    def setup(self):
+        """
+        Setup: The parameters of the sensor and its charge amplifier.
+        """
+        return self._load(CONFIGURATION_FILE, Setup.from_dict)
+
+    @property
+    def calibration(self):
+        """
+        Calibration: The offsets and trend lines of the channels.
+        """
+        return self._load(CALIBRATION_FILE, Calibration)
+
+    def _derive(self, name, build):
+        """
+        Returns a value derived from the setup, building it again only if the setup changed.
+
+        Args:
+            name (str): The name of the value.
+            build (callable): The function creating the value from the setup.
+
+        Returns:
+            The value.
+        """
+        setup = self.setup
+        with self.lock:
+            cached = self._derived.get(name)
+            if cached is None or cached[0] != setup:
+                cached = (setup, build(setup))
+                self._derived[name] = cached
+            return cached[1]
+
+    @property
+    def system(self):
+        """
+        scipy.signal.lti: The system relating the response to the force.
+        """
+        # Imported here, as the reconstruction imports the modules using the settings
+        from reconstruction import create_system
+        return self._derive("system", lambda setup: create_system(setup.Rf, setup.Cf, setup.d33))
+
+    def reconstructor(self):
+        """
+        Returns a new reconstructor at rest for the current setup.
+
+        Returns:
+            Reconstructor: A copy of the reconstructor discretized once for the setup.
+        """
+        from reconstruction import Reconstructor
+        prototype = self._derive("reconstructor", lambda setup: Reconstructor(self.system, setup.T))
+        reconstructor = copy.deepcopy(prototype)
+        reconstructor.reset()
+        return reconstructor
+
+    def update_calibration(self, offsets=None, a=None, b=None):
+        """
+        Writes new calibration values for every given channel.
+
+        Channels missing in the file, such as the channels of further boards,
+        are added with zero for the values not given. The file is replaced
+        atomically and the cached calibration follows it.
+
+        Args:
+            offsets (numpy.ndarray, optional): The offset of every channel. Defaults to None, which keeps them.
+            a (numpy.ndarray, optional): The trend slope of every channel. Defaults to None, which keeps them.
+            b (numpy.ndarray, optional): The trend intercept of every channel. Defaults to None, which keeps them.
+
+        Returns:
+            Calibration: The new calibration.
+        """
+        with self.lock:
+            data = copy.deepcopy(self.calibration.data)
+            values = {key: np.ravel(vector) for key, vector in (('offset_mean', offsets), ('a', a), ('b', b))
+                      if vector is not None}
+            entries = {entry["number"]: entry for entry in data['channels']}
+            for i in range(max((len(vector) for vector in values.values()), default=0)):
+                entry = entries.setdefault(i + 1, {"number": i + 1, 'offset_mean': 0.0, 'a': 0.0, 'b': 0.0})
+                for key, vector in values.items():
+                    entry[key] = float(vector[i])
+            data['channels'] = sorted(entries.values(), key=lambda entry: entry["number"])
+            path = os.path.join(self.config_path, CALIBRATION_FILE)
+            write_yaml(path, data)
+            status = os.stat(path)
+            calibration = Calibration(data)
+            self._files[CALIBRATION_FILE] = ((path, status.st_mtime_ns, status.st_size), calibration)
+            return calibration
+
+# Settings of the current setup, shared by all modules
+settings = Settings()
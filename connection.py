@@ -1,49 +1,231 @@
-import ftd2xx as ftd
 import numpy as np
 import time
 import matplotlib.pyplot as plt
 
+# Internal imports
+from instrumentation import metrics
+
+# The FTDI driver is only needed to open a device, decoding and replay work without it
+try:
+    import ftd2xx as ftd
+except (ImportError, OSError):
+    ftd = None
+
 class FTDI():
     """
     A class to handle interactions with an FTDI device for reading data.
     """
     
-    def __init__(self, id=0):
+    def __init__(self, id=0, transfer_size=None, latency=None, timeout=None):
         """
         Initializes the FTDI device connection.
 
         Args:
             id (int, optional): The ID of the FTDI device to connect to. Defaults to 0.
+            transfer_size (int, optional): The USB transfer size for received data in bytes.
+                Defaults to None, which keeps the setting of the device.
+            latency (int, optional): The latency timer in milliseconds, after which a partly
+                filled transfer is sent. Defaults to None, which keeps the setting of the device.
+            timeout (float, optional): The longest wait of a blocking read in seconds.
+                Defaults to None, which keeps the setting of the device.
         """
+        if ftd is None:
+            raise ImportError("The ftd2xx package and the FTDI D2XX driver are required to open a device.")
         # Open the connection to the FTDI device
         self.device = ftd.open(id)
+        self.timeout = None  # Read timeout set through configure
         # self.device.setBaudRate(baudRate)  # Uncomment to set baud rate if needed
+        self.configure(transfer_size, latency, timeout)
+
+    def configure(self, transfer_size=None, latency=None, timeout=None):
+        """
+        Changes the USB transfer size, the latency timer and the read timeout.
+
+        Larger transfers and a longer latency give fewer, larger reads; a shorter
+        latency delivers small amounts of data sooner.
+
+        Args:
+            transfer_size (int, optional): The USB transfer size for received data in bytes,
+                a multiple of 64. Defaults to None, which keeps the current one.
+            latency (int, optional): The latency timer in milliseconds, from 2 to 255.
+                Defaults to None, which keeps the current one.
+            timeout (float, optional): The longest wait of a blocking read in seconds.
+                Defaults to None, which keeps the current one.
+        """
+        if transfer_size is not None:
+            self.device.setUSBParameters(transfer_size)
+        if latency is not None:
+            self.device.setLatencyTimer(latency)
+        if timeout is not None:
+            self.timeout = timeout
+            self.device.setTimeouts(int(timeout * 1000), int(timeout * 1000))
     
-    def read(self):
+    def read(self, out=None):
         """
         Reads data from the FTDI device.
 
+        The received bytes are exposed as a ``uint8`` NumPy array without
+        creating a Python object per byte.
+
+        Args:
+            out (numpy.ndarray, optional): Preallocated ``uint8`` buffer to fill.
+                At most ``len(out)`` bytes are read. Defaults to None.
+
         Returns:
-            list: The data read from the device.
+            numpy.ndarray: A ``uint8`` view over the received bytes, or the
+                filled leading part of ``out`` if it was supplied.
         """
         # Get the number of bytes in the receive queue
         self.queue = self.device.getQueueStatus()
-        # Read the data from the queue
-        read = self.device.read(self.queue)
-        data = []
-        for char in read:
-            data.append(char)
-        return data
+        metrics.gauge("device backlog bytes", self.queue)
+        if out is not None:
+            self.queue = min(self.queue, len(out))
+        # Read the data from the queue and view it as an array of bytes
+        read = np.frombuffer(self.device.read(self.queue), dtype=np.uint8)
+        if out is None:
+            return read
+        out[:len(read)] = read
+        return out[:len(read)]
     
+    def read_block(self, min_bytes, out=None):
+        """
+        Waits until at least a number of bytes arrived and reads them.
+
+        The driver blocks until the bytes are received or the timeout passes,
+        so no CPU is spent while waiting. Everything already waiting is read as well.
+
+        Args:
+            min_bytes (int): The number of bytes to wait for.
+            out (numpy.ndarray, optional): Preallocated ``uint8`` buffer to fill.
+                At most ``len(out)`` bytes are read. Defaults to None.
+
+        Returns:
+            numpy.ndarray: The received bytes, fewer than ``min_bytes`` if the
+                timeout passed, or the filled leading part of ``out``.
+        """
+        self.queue = self.device.getQueueStatus()
+        metrics.gauge("device backlog bytes", self.queue)
+        count = max(self.queue, min_bytes)
+        if out is not None:
+            count = min(count, len(out))
+        read = np.frombuffer(self.device.read(count), dtype=np.uint8)
+        if out is None:
+            return read
+        out[:len(read)] = read
+        return out[:len(read)]
+
     def close(self):
         """
         Closes the connection to the FTDI device.
         """
         self.device.close()
 
+class FrameDecoder():
+    """
+    A class to decode the FTDI byte stream into 16-channel samples.
+
+    The decoder keeps the bytes of incomplete frames and the channel phase
+    between calls, so a stream split into arbitrary chunks decodes without gaps.
+    It searches for the start sequence only at the beginning of the stream or
+    after the frame layout has been lost. In raw mode the 12-bit ADC codes are
+    returned as uint16, a quarter of the size of volts in float64, and the
+    scaling is left to the consumers.
+    """
+
+    PACKET_SIZE = 9  # Bytes sent by the firmware per channel
+    CHANNELS = 16  # Channels in a single frame
+    FRAME_SIZE = PACKET_SIZE * CHANNELS
+    VOLTS_PER_CODE = 3.3 / 4096  # Scaling of the 12-bit ADC codes
+
+    def __init__(self, raw=False):
+        """
+        Initializes the decoder in the unsynchronized state.
+
+        Args:
+            raw (bool, optional): Return the ADC codes instead of volts. Defaults to False.
+        """
+        self.raw = raw
+        # Channel identifiers at bytes 0, 3 and 6 of every packet, matching
+        # the firmware design for 48 channels
+        self.identifiers = np.arange(48).reshape(3, self.CHANNELS).T
+        # Order of the output rows relative to the packets in a frame
+        self.order = np.roll(np.arange(self.CHANNELS), -2)
+        self.reset()
+
+    def reset(self):
+        """
+        Discards the buffered bytes and forces a new synchronization.
+        """
+        self.buffer = np.empty(0, dtype=np.uint8)
+        self.synced = False
+
+    def _synchronize(self):
+        """
+        Moves the buffer to the first start sequence found in it.
+
+        Returns:
+            bool: True if the start sequence was found.
+        """
+        buff = self.buffer
+        if len(buff) < 10:
+            return False
+        # Look for the 0/16/32/1 pattern at offsets 0, 3, 6 and 9
+        start = np.flatnonzero((buff[:-9] == 0) & (buff[3:-6] == 16) &
+                               (buff[6:-3] == 32) & (buff[9:] == 1))
+        if len(start) == 0:
+            # Keep the tail, as the pattern may continue in the next chunk
+            metrics.count("bytes discarded", len(buff) - 9)
+            self.buffer = buff[-9:]
+            return False
+        metrics.count("bytes discarded", start[0].item())
+        metrics.count("resynchronizations")
+        self.buffer = buff[start[0]:]
+        self.synced = True
+        return True
+
+    def decode(self, chunk):
+        """
+        Decodes a chunk of the byte stream.
+
+        Args:
+            chunk (numpy.ndarray): The bytes read from the FTDI device.
+
+        Returns:
+            numpy.ndarray: The complete samples in volts, or the uint16 ADC codes
+                in raw mode, shaped (16, samples).
+        """
+        self.buffer = np.concatenate((self.buffer, chunk))
+        codes = []
+        while self.synced or self._synchronize():
+            # Split the buffer into complete frames of 16 packets
+            count = len(self.buffer) // self.FRAME_SIZE
+            frames = self.buffer[:count * self.FRAME_SIZE].reshape(count, self.CHANNELS, self.PACKET_SIZE)
+            # Accept frames up to the first one with unexpected identifiers
+            invalid = np.flatnonzero(np.any(frames[:, :, [0, 3, 6]] != self.identifiers, axis=(1, 2)))
+            valid = invalid[0] if len(invalid) else count
+            frames = frames[:valid]
+            codes.append((frames[:, :, 4].astype(np.uint16) << 8) + frames[:, :, 5])
+            self.buffer = self.buffer[valid * self.FRAME_SIZE:]
+            if valid == count:
+                break
+            # The frame layout was lost, drop a byte and search again
+            metrics.count("bytes discarded")
+            self.buffer = self.buffer[1:]
+            self.synced = False
+
+        if not codes:
+            return np.empty((self.CHANNELS, 0), dtype=np.uint16 if self.raw else np.float64)
+        codes = np.concatenate(codes)
+        metrics.count("frames decoded", len(codes))
+        if self.raw:
+            return np.ascontiguousarray(codes[:, self.order].T)
+        return codes[:, self.order].T * self.VOLTS_PER_CODE
+
 def process_FTDI_readings(Obuff, Channels=15):
     """
-    Processes the readings from the FTDI device.
+    Processes a complete buffer of readings from the FTDI device.
+
+    Use a FrameDecoder directly to process a stream chunk by chunk.
 
     Args:
         Obuff (numpy.ndarray): The buffer of readings from the FTDI device.
@@ -52,47 +234,32 @@ def process_FTDI_readings(Obuff, Channels=15):
     Returns:
         numpy.ndarray: The processed readings.
     """
-    vector = np.arange(48)
-    # Reshape the vector to match the firmware design for 48 channels
-    Channels = vector.reshape(3, 16, order='F').flatten()
-    
-    # Find the index of the starting sequence in the buffer
-    ind = np.where(Obuff == 0)[0]
-    for i in range(len(ind) - 100):
-        if (Obuff[ind[i]] == 0 and Obuff[ind[i] + 3] == 16 and 
-            Obuff[ind[i] + 6] == 32 and Obuff[ind[i] + 9] == 1):
-            break
-
-    # Delete the initial portion of the buffer before the start sequence
-    Obuff = np.delete(Obuff, slice(0, ind[i]))
-    Obuff = Obuff.astype(np.uint16)
-    
-    # Process the buffer to get the desired channels' data
-    if len(Obuff[4::9] << 8) == len(Obuff[5::9]):
-        Ocode1 = (Obuff[4::9] << 8) + Obuff[5::9]
-    else:
-        Ocode1 = (Obuff[4::9] << 8)[:-1] + Obuff[5::9]
-    
-    # Adjust the length to be a multiple of 16 and reshape the result
-    Ocode1 = Ocode1[:-(len(Ocode1) % 16)]
-    result = np.reshape(Ocode1, (16, int(len(Ocode1) / 16)), order='F') * 3.3 / 4096
-    result = np.roll(result, -2, axis=0)
-    return result
+    decoder = FrameDecoder()
+    readings = decoder.decode(Obuff)
+    # The bytes of an incomplete last frame are dropped
+    metrics.count("bytes discarded", len(decoder.buffer))
+    return readings
 
 if __name__ == '__main__':
+    replay = False  # Replay a synthetic signal instead of reading a board
+
     # Initialize the FTDI device
-    device = FTDI()
-    readings = [0]
+    if replay:
+        from replay import ReplayDevice
+        device = ReplayDevice()
+    else:
+        device = FTDI()
+    readings = []
     # Get the current time
     start_time = time.time()
     # Read data for 3 seconds
     while time.time() - start_time < 3:
         data = device.read()
-        if data:
-            readings = np.concatenate([readings, data])
+        if len(data):
+            readings.append(data)
     
     # Process the readings
-    proces = process_FTDI_readings(np.array(readings).flatten().astype(int))
+    proces = process_FTDI_readings(np.concatenate(readings))
     # Plot the results
     plt.figure()
     plt.plot(proces[13, :])
@@ -0,0 +1,139 @@
+# External imports
+from collections import deque, namedtuple
+import queue
+import numpy as np
+
+# A contact detected on one channel, with its start time and duration in seconds and its peak force
+Event = namedtuple('Event', ['time', 'channel', 'peak', 'duration'])
+
+class EventDetector():
+    """
+    A class to detect contacts and taps in the reconstructed force as it streams in.
+
+    A contact starts when the force of a channel rises above the threshold and
+    ends when it falls below the release level. The state of every channel
+    carries over between chunks, so only the new samples are scanned and each
+    contact is reported exactly once, when it ends.
+
+    Only the most recent events are kept in history, so a long session does
+    not grow without bound. Consumers in other threads get a bounded queue
+    from subscribe_queue; events are dropped for a consumer whose queue is full.
+    """
+
+    def __init__(self, channels, T, threshold, release=None, min_duration=0.0, history=10000):
+        """
+        Initializes the detector.
+
+        Args:
+            channels (int): The number of channels.
+            T (float): The sampling frequency.
+            threshold (float or numpy.ndarray): The force starting a contact, or one per channel shaped (channels, 1).
+            release (float or numpy.ndarray, optional): The force ending a contact. Defaults to half the threshold.
+            min_duration (float, optional): The shortest contact reported, in seconds. Defaults to 0.0.
+            history (int, optional): The number of recent events kept in history. Defaults to 10000.
+        """
+        self.channels = channels
+        self.T = T
+        self.threshold = threshold
+        self.release = threshold / 2 if release is None else release
+        self.min_duration = min_duration
+        self.history_size = history
+        self.callbacks = []
+        self.queues = []  # Events for consumers in other threads
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the running contacts and the detected events.
+        """
+        self.position = 0  # Samples seen since the reset
+        self.active = np.zeros(self.channels, dtype=bool)
+        self.start = np.zeros(self.channels, dtype=int)
+        self.peak = np.full(self.channels, -np.inf)
+        self.history = deque(maxlen=self.history_size)  # The latest events detected since the reset
+
+    def subscribe(self, callback):
+        """
+        Registers a function called with every detected event.
+
+        Args:
+            callback (callable): The function taking an Event.
+        """
+        self.callbacks.append(callback)
+
+    def subscribe_queue(self, maxsize=1000):
+        """
+        Creates a queue receiving every detected event, for a consumer in another thread.
+
+        Args:
+            maxsize (int, optional): The number of events the queue holds. Events detected
+                while it is full are dropped for this consumer. Defaults to 1000.
+
+        Returns:
+            queue.Queue: The queue.
+        """
+        events = queue.Queue(maxsize)
+        self.queues.append(events)
+        return events
+
+    def process(self, chunk):
+        """
+        Scans new samples for contacts.
+
+        Args:
+            chunk (numpy.ndarray): The new force samples, shaped (channels, samples).
+
+        Returns:
+            list: The events that ended within the chunk.
+        """
+        n = np.size(chunk, 1)
+        if n == 0:
+            return []
+        # Mark the samples that switch a contact on or off, with the current state first
+        switch = np.zeros((self.channels, n + 1), dtype=np.int8)
+        switch[:, 0] = np.where(self.active, 1, -1)
+        switch[:, 1:][chunk > self.threshold] = 1
+        switch[:, 1:][chunk < self.release] = -1
+        # Hold the last switch to get the state at every sample
+        index = np.where(switch != 0, np.arange(n + 1), 0)
+        state = np.take_along_axis(switch, np.maximum.accumulate(index, axis=1), axis=1) > 0
+        changes = np.diff(state.astype(np.int8), axis=1)
+
+        events = []
+        for channel in np.flatnonzero(np.any(changes != 0, axis=1) | self.active):
+            starts = list(np.flatnonzero(changes[channel] > 0))
+            ends = list(np.flatnonzero(changes[channel] < 0))
+            if self.active[channel]:
+                starts.insert(0, None)
+            for start, end in zip(starts, ends):
+                first = 0 if start is None else start
+                peak = chunk[channel, first:end].max(initial=-np.inf)
+                if start is None:
+                    start, peak = self.start[channel] - self.position, max(peak, self.peak[channel])
+                duration = float(end - start) / self.T
+                if duration >= self.min_duration:
+                    events.append(Event(float(self.position + start) / self.T, int(channel), float(peak), duration))
+            # Keep the contact still running at the end of the chunk
+            self.active[channel] = state[channel, -1]
+            if self.active[channel]:
+                if len(starts) > len(ends):
+                    if starts[-1] is None:
+                        self.peak[channel] = max(self.peak[channel], chunk[channel].max())
+                    else:
+                        self.start[channel] = self.position + starts[-1]
+                        self.peak[channel] = chunk[channel, starts[-1]:].max()
+            else:
+                self.peak[channel] = -np.inf
+        self.position += n
+
+        events.sort(key=lambda event: event.time)
+        for event in events:
+            self.history.append(event)
+            for events_queue in self.queues:
+                try:
+                    events_queue.put_nowait(event)
+                except queue.Full:
+                    pass
+            for callback in self.callbacks:
+                callback(event)
+        return events
@@ -1,41 +1,50 @@
 # External imports
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import pandas as pd
 import os
 import json
 from datetime import datetime
 import shutil
-import yaml
 
 # Internal imports
 from config.path_config import *
+from config.settings import settings
+from instrumentation import metrics
+from connection import FrameDecoder
+from catalog import Catalog
 
 class Data_Handler():
     """
     A class to handle data related to readings and their metadata, 
     including saving responses, reconstructions, and metadata, 
     as well as creating plots.
+
+    The catalog entry of the reading is updated when the recording is
+    finished and when the metadata is saved, which completes a reading.
     """
     
-    def __init__(self, name, response):
+    def __init__(self, name, response=None, readings_dir=READINGS_DIR):
         """
         Initializes the Data_Handler object.
 
         Args:
             name (str): The name of the reading.
-            response (numpy.ndarray): The response data to be handled.
+            response (numpy.ndarray, optional): The response data to be handled.
+                Leave empty when the response is recorded while acquiring. Defaults to None.
+            readings_dir (str, optional): The directory holding the reading folders and
+                their catalog. Defaults to READINGS_DIR.
         """
-        # Load configuration from YAML file
-        with open(CONFIG_PATH + CONFIGURATION_FILE, 'r') as f:
-            data = yaml.safe_load(f)
-            for key, value in data.items():
-                setattr(self, key, value)
+        # Take the setup parameters from the cached configuration
+        self.setup = settings.setup
+        self.T = self.setup.T
         
         self.current_datetime = datetime.now()
         self.name = name
-        self.newpath = READINGS_DIR + self.name
+        self.readings_dir = readings_dir
+        self.newpath = os.path.join(readings_dir, self.name)
         self.response = response
+        self.writer = None
         self._create_folder()
 
     def _create_folder(self):
@@ -46,32 +55,102 @@ class Data_Handler():
         if not os.path.exists(self.newpath):
             os.makedirs(self.newpath)
 
-    def save_response(self):
+    def _update_catalog(self):
+        """
+        Indexes the saved files of the reading in the catalog of the readings directory.
+        """
+        with Catalog(self.readings_dir) as catalog:
+            catalog.update(self.name)
+
+    def _save_matrix(self, matrix, name, file_format):
+        """
+        Saves a matrix with one row per sample in the chosen format.
+
+        Args:
+            matrix (numpy.ndarray): The data to be saved.
+            name (str): The name of the file without the extension.
+            file_format (str): "binary" or "csv".
+        """
+        if file_format not in ("binary", "csv"):
+            raise ValueError(f"Unknown file format '{file_format}'.")
+        scale = code_scale(matrix.dtype)
+        with metrics.timer("save"):
+            if file_format == "binary":
+                write_recording(self.newpath + "/" + name, matrix, self.T, scale)
+            else:
+                # CSV files hold volts, as they have no header for the scale
+                data = pd.DataFrame(matrix if scale is None else matrix * scale)
+                data.to_csv(self.newpath + "/" + name + ".csv", index=False)
+
+    def save_response(self, file_format="binary"):
+        """
+        Saves the response data to a file.
+
+        Args:
+            file_format (str, optional): "binary" for raw values with a JSON header,
+                or "csv". Defaults to "binary".
+        """
+        self._save_matrix(self.response, "output", file_format)
+
+    def record(self, samples):
         """
-        Saves the response data to a CSV file.
+        Appends newly acquired samples to the response file on disk.
+
+        Args:
+            samples (numpy.ndarray): The samples to append, shaped (channels, samples).
         """
-        data = pd.DataFrame(self.response)
-        data.to_csv(self.newpath + "/output.csv", index=False) 
+        if self.writer is None:
+            # Raw ADC codes are stored as they are, with their scale in the header
+            self.writer = Recording_Writer(self.newpath + "/output", np.size(samples, 0), self.T,
+                                           dtype=samples.dtype.newbyteorder('<').str, scale=code_scale(samples.dtype))
+        with metrics.timer("save"):
+            self.writer.write(samples)
 
-    def save_reconstruction(self, reconstruction):
+    def finish_recording(self):
+        """
+        Writes the remaining recorded samples and closes the response file.
         """
-        Saves the reconstruction data to a CSV file.
+        if self.writer is not None:
+            self.writer.close()
+            self._update_catalog()
+
+    def save_reconstruction(self, reconstruction, file_format="binary"):
+        """
+        Saves the reconstruction data to a file.
 
         Args:
             reconstruction (numpy.ndarray): The reconstructed data to be saved.
+            file_format (str, optional): "binary" for raw values with a JSON header,
+                or "csv". Defaults to "binary".
         """
         setattr(self, "reconstruction", reconstruction)
-        data = pd.DataFrame(self.reconstruction)
-        data.to_csv(self.newpath + "/reconstruction.csv", index=False) 
+        self._save_matrix(self.reconstruction, "reconstruction", file_format)
+
+    def save_events(self, events):
+        """
+        Saves the detected contact events to a CSV file.
+
+        Args:
+            events (list): The events, as returned by EventDetector.
+        """
+        data = pd.DataFrame(events, columns=["time", "channel", "peak", "duration"])
+        data.to_csv(self.newpath + "/events.csv", index=False)
 
     def save_metadata(self, description):
         """
         Saves metadata related to the reading to a JSON file.
 
+        Save it after the other files, as it also indexes the reading in the catalog.
+
         Args:
             description (str): Description of the reading.
         """
-        duration = max(np.shape(self.response))/self.T
+        if self.response is not None:
+            duration = max(np.shape(self.response))/self.T
+        elif self.writer is not None:
+            duration = self.writer.samples/self.T
+        else:
+            duration = 0
         metadata = {
             "reading name": self.name,
             "length of signal": str(duration) + " seconds",
@@ -84,6 +163,7 @@ class Data_Handler():
         }
         with open(self.newpath + '/metadata.json', 'w') as json_file:
             json.dump(metadata, json_file, indent=4)
+        self._update_catalog()
 
     def save_configuration(self):
         """
@@ -96,16 +176,24 @@ class Data_Handler():
         """
         Saves figures of the response and reconstruction data to files.
 
+        The figure is drawn without pyplot, so it can be saved from a background thread.
+
         Args:
             channel (int): The channel number to plot.
         """
+        # Take the channel from disk if the response was recorded while acquiring
+        if self.response is not None:
+            response = self.response[:,channel] * (code_scale(self.response.dtype) or 1.0)
+        else:
+            response = Recording(self.newpath + "/output")[channel, :]
         # Create the time vector for the response plot
-        time_res = np.linspace(0, len(self.response[:,channel])/self.T, len(self.response[:,channel]))
+        time_res = np.linspace(0, len(response)/self.T, len(response))
         # Create the figure and subplots
-        fig, (ax_res, ax_rec) = plt.subplots(2, sharex=True)
+        fig = Figure()
+        ax_res, ax_rec = fig.subplots(2, sharex=True)
         
         # Plot the response
-        ax_res.plot(time_res, self.response[:,channel])
+        ax_res.plot(time_res, response)
         ax_res.set_ylabel('Response [V]')
         ax_res.set_ylim(0, 3.3)
         ax_res.set_title('Raw piezoelectric response')
@@ -120,29 +208,261 @@ class Data_Handler():
             ax_rec.set_title('Reconstructed force')
         
         # Adjust layout and save the plots
-        plt.tight_layout()
-        plt.savefig(self.newpath + "/figure.pdf")
-        plt.savefig(self.newpath + "/figure.eps")
-        plt.close()
+        fig.tight_layout()
+        fig.savefig(self.newpath + "/figure.pdf")
+        fig.savefig(self.newpath + "/figure.eps")
 
-def name_handler(name):
+class Recording_Writer():
     """
-    Handles naming conflicts by appending a number to the file name if it already exists.
+    A class to write samples to disk in fixed-size blocks while they are acquired.
+
+    The samples are stored as raw little-endian values, one row per sample,
+    next to a JSON header. The number of samples follows from the file size,
+    so everything written before a crash stays readable.
+    """
+
+    def __init__(self, path, channels, T, block_size=4096, dtype='<f8', scale=None):
+        """
+        Initializes the writer and creates the data and header files.
+
+        Args:
+            path (str): The path of the files without the extension.
+            channels (int): The number of channels.
+            T (float): The sampling frequency.
+            block_size (int, optional): The number of samples written at once. Defaults to 4096.
+            dtype (str, optional): The type of the stored values. Defaults to '<f8'.
+            scale (float, optional): The volts per stored value for raw ADC codes. Defaults to None.
+        """
+        self.path = path
+        self.header = recording_header(dtype, None, channels, T, scale)
+        self.block = np.zeros((block_size, channels), dtype=dtype)
+        self.filled = 0  # Samples waiting in the current block
+        self.samples = 0  # Samples written so far
+        write_header(self.path, self.header)
+        self.file = open(self.path + ".bin", 'wb')
+
+    def _flush_block(self):
+        """
+        Writes the filled part of the current block to disk.
+        """
+        self.file.write(self.block[:self.filled].tobytes())
+        self.file.flush()
+        self.filled = 0
+
+    def write(self, samples):
+        """
+        Appends samples to the data file.
+
+        Args:
+            samples (numpy.ndarray): The samples to append, shaped (channels, samples).
+        """
+        samples = np.transpose(samples)
+        while len(samples):
+            count = min(len(samples), len(self.block) - self.filled)
+            self.block[self.filled:self.filled + count] = samples[:count]
+            self.filled += count
+            self.samples += count
+            samples = samples[count:]
+            if self.filled == len(self.block):
+                self._flush_block()
+
+    def close(self):
+        """
+        Writes the remaining samples, closes the data file and completes the header.
+        """
+        self._flush_block()
+        self.file.close()
+        self.header["shape"][0] = self.samples
+        write_header(self.path, self.header)
+
+def code_scale(dtype):
+    """
+    Returns the scale of samples of the given type.
+
+    Args:
+        dtype (numpy.dtype): The type of the samples.
+
+    Returns:
+        float: The volts per ADC code for integer samples, None for samples in volts.
+    """
+    return FrameDecoder.VOLTS_PER_CODE if np.issubdtype(dtype, np.integer) else None
+
+def recording_header(dtype, samples, channels, T, scale=None):
+    """
+    Creates the JSON header describing a binary recording.
 
     Args:
-        name (str): The original name of the file.
+        dtype (str): The type of the stored values.
+        samples (int): The number of samples, None while it is unknown.
+        channels (int): The number of channels.
+        T (float): The sampling frequency.
+        scale (float, optional): The volts per stored value for raw ADC codes. Defaults to None.
 
     Returns:
-        str: The new name of the file, with a number appended if there was a conflict.
-    """
-    if os.path.exists(READINGS_DIR + name):
-        i = 2
-        print(f"The file '{name}' already exists.")
-        while True:
-            if os.path.exists(READINGS_DIR + name + str(i) + ".csv"):
-                i += 1
+        dict: The header.
+    """
+    header = {
+        "dtype": np.dtype(dtype).newbyteorder('<').str,
+        "shape": [samples, channels],
+        "T": T,
+        "channel map": list(range(1, channels + 1)),
+    }
+    if scale is not None:
+        header["scale"] = scale
+    return header
+
+def write_header(path, header):
+    """
+    Writes the JSON header of a binary recording.
+
+    Args:
+        path (str): The path of the recording without the extension.
+        header (dict): The header.
+    """
+    with open(path + ".json", 'w') as json_file:
+        json.dump(header, json_file, indent=4)
+
+def write_recording(path, data, T, scale=None):
+    """
+    Writes a complete matrix as a binary recording.
+
+    The values are stored as raw little-endian numbers, one row per sample,
+    in a .bin file next to a .json header.
+
+    Args:
+        path (str): The path of the recording without the extension.
+        data (numpy.ndarray): The data with one row per sample.
+        T (float): The sampling frequency.
+        scale (float, optional): The volts per stored value for raw ADC codes. Defaults to None.
+    """
+    data = np.asarray(data)
+    data = data.reshape(len(data), -1)
+    header = recording_header(data.dtype, len(data), np.size(data, 1), T, scale)
+    write_header(path, header)
+    data.astype(header["dtype"], copy=False).tofile(path + ".bin")
+
+def read_recording(path):
+    """
+    Reads a complete recording saved in the binary or the CSV format.
+
+    The binary format is preferred when both exist. The number of samples
+    is taken from the file size, so recordings interrupted by a crash load too.
+    Raw ADC codes are converted to volts.
+
+    Args:
+        path (str): The path of the recording without the extension.
+
+    Returns:
+        tuple: The data with one row per sample, and the header, which is
+            None for CSV files.
+    """
+    recording = Recording(path)
+    if recording.scale is not None:
+        return np.asarray(recording.data) * recording.scale, recording.header
+    return np.array(recording.data), recording.header
+
+class Recording():
+    """
+    A class to access a saved recording lazily.
+
+    Binary recordings are memory-mapped, so opening one takes no time and
+    only the selected time windows are read from disk. The samples are
+    stored one after the other, so selecting a channel still reads the
+    other channels of the window. CSV recordings are loaded into memory
+    and offer the same interface.
+    Indexing is channel first, like the live buffers: rec[channel, t0:t1].
+    Recordings of raw ADC codes are scaled to volts only for the selection.
+    """
+
+    def __init__(self, path, raw=False):
+        """
+        Opens the recording.
+
+        Args:
+            path (str): The path of the recording without the extension.
+            raw (bool, optional): Return the stored ADC codes of raw recordings
+                instead of volts. Defaults to False.
+        """
+        self.path = path
+        self.raw = raw
+        if os.path.exists(path + ".bin"):
+            with open(path + ".json", 'r') as json_file:
+                self.header = json.load(json_file)
+            dtype = np.dtype(self.header["dtype"])
+            channels = self.header["shape"][1]
+            # Take the number of samples from the file size, in case the recording was interrupted
+            samples = os.path.getsize(path + ".bin") // (dtype.itemsize * channels)
+            if samples:
+                self.data = np.memmap(path + ".bin", dtype=dtype, mode='r', shape=(samples, channels))
             else:
-                break
-        name = name + str(i) + ".csv"
-        print(f"Saving file as '{name}'.")   
-    return name
+                self.data = np.zeros((0, channels), dtype=dtype)
+            self.T = self.header["T"]
+            self.scale = self.header.get("scale")
+        else:
+            self.header = None
+            self.data = pd.read_csv(path + ".csv").to_numpy()
+            self.T = None
+            self.scale = None
+
+    @property
+    def shape(self):
+        """
+        tuple: The number of channels and samples.
+        """
+        return np.size(self.data, 1), np.size(self.data, 0)
+
+    def __len__(self):
+        """
+        Returns the number of samples.
+        """
+        return np.size(self.data, 0)
+
+    def __getitem__(self, key):
+        """
+        Reads a channel and time window selection.
+
+        Args:
+            key: A channel index or slice, optionally followed by a sample index or slice.
+
+        Returns:
+            numpy.ndarray: The selected data, channels first.
+        """
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        channel, time = key
+        if self.scale is not None and not self.raw:
+            return (np.asarray(self.data[time, channel]) * self.scale).T
+        return np.array(self.data[time, channel]).T
+
+    def iter_chunks(self, size, channel=slice(None)):
+        """
+        Iterates over the recording in consecutive chunks.
+
+        Args:
+            size (int): The number of samples per chunk.
+            channel (int or slice, optional): The channels to read. Defaults to all channels.
+
+        Yields:
+            numpy.ndarray: The next chunk, channels first.
+        """
+        for start in range(0, len(self), size):
+            yield self[channel, start:start + size]
+
+def name_handler(name):
+    """
+    Handles naming conflicts by appending a number to the reading name if it already exists.
+
+    The next free number of every name is kept in the catalog of the readings directory.
+
+    Args:
+        name (str): The original name of the reading.
+
+    Returns:
+        str: The new name of the reading, with a number appended if there was a conflict.
+    """
+    with Catalog() as catalog:
+        new_name = catalog.allocate(name)
+    if new_name != name:
+        print(f"The reading '{name}' already exists.")
+        print(f"Saving reading as '{new_name}'.")
+    return new_name
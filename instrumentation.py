@@ -0,0 +1,233 @@
+# External imports
+from contextlib import contextmanager
+import json
+import math
+import threading
+import time
+import numpy as np
+
+class Histogram():
+    """
+    A class to collect durations in logarithmic bins, from a microsecond to ten seconds.
+
+    Recording a duration costs a few arithmetic operations, so stages running
+    thousands of times per second can be timed continuously.
+    """
+
+    BINS_PER_DECADE = 10
+    LOWEST = 1e-6  # Upper edge of the first bin in seconds
+    DECADES = 7
+
+    def __init__(self):
+        """
+        Initializes an empty histogram.
+        """
+        self.counts = np.zeros(self.DECADES * self.BINS_PER_DECADE + 1, dtype=np.int64)
+        # Upper edges of the bins, the last bin holds everything longer
+        self.edges = self.LOWEST * 10 ** (np.arange(len(self.counts)) / self.BINS_PER_DECADE)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        """
+        Adds a duration.
+
+        Args:
+            duration (float): The duration in seconds.
+        """
+        duration = float(duration)
+        if duration > self.LOWEST:
+            index = min(math.ceil(math.log10(duration / self.LOWEST) * self.BINS_PER_DECADE), len(self.counts) - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, q):
+        """
+        Returns an upper bound of a percentile of the durations.
+
+        Args:
+            q (float): The percentile between 0 and 100.
+
+        Returns:
+            float: The upper edge of the bin holding the percentile in seconds.
+        """
+        if self.count == 0:
+            return 0.0
+        index = np.searchsorted(np.cumsum(self.counts), q / 100 * self.count)
+        return float(min(self.edges[index], self.max))
+
+    def summary(self):
+        """
+        Summarizes the durations.
+
+        Returns:
+            dict: The number of durations and their mean, percentiles and maximum in milliseconds.
+        """
+        return {
+            "count": self.count,
+            "mean ms": self.total / self.count * 1e3 if self.count else 0.0,
+            "p50 ms": self.percentile(50) * 1e3,
+            "p99 ms": self.percentile(99) * 1e3,
+            "max ms": self.max * 1e3,
+        }
+
+class Metrics():
+    """
+    A class to collect the timings, counters and gauges of the pipeline stages.
+
+    All methods are thread-safe, so the acquisition threads and the GUI can
+    report to the same instance.
+    """
+
+    def __init__(self):
+        """
+        Initializes empty metrics.
+        """
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Discards all collected values.
+        """
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            self.gauges = {}
+            self.start_time = time.time()
+
+    def record(self, name, duration):
+        """
+        Adds a duration to the histogram of a stage.
+
+        Args:
+            name (str): The name of the stage.
+            duration (float): The duration in seconds.
+        """
+        with self.lock:
+            if name not in self.timers:
+                self.timers[name] = Histogram()
+            self.timers[name].add(duration)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Times the enclosed block as a stage.
+
+        Args:
+            name (str): The name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        """
+        Increases a counter.
+
+        Args:
+            name (str): The name of the counter.
+            value (int, optional): The increase. Defaults to 1.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Sets a gauge to its current value and keeps its maximum.
+
+        Args:
+            name (str): The name of the gauge.
+            value (float): The current value.
+        """
+        with self.lock:
+            peak = self.gauges.get(name, {}).get("max", value)
+            self.gauges[name] = {"value": value, "max": max(peak, value)}
+
+    def stats(self):
+        """
+        Returns a snapshot of all collected values.
+
+        Returns:
+            dict: The timing summaries of the stages, the counters and the gauges.
+        """
+        with self.lock:
+            return {
+                "time": time.time(),
+                "uptime s": time.time() - self.start_time,
+                "timers": {name: histogram.summary() for name, histogram in self.timers.items()},
+                "counters": dict(self.counters),
+                "gauges": {name: dict(gauge) for name, gauge in self.gauges.items()},
+            }
+
+# Metrics shared by all stages of the pipeline
+metrics = Metrics()
+
+def format_stats(stats):
+    """
+    Formats a snapshot of the metrics as short lines of text for display.
+
+    Args:
+        stats (dict): The snapshot returned by Metrics.stats.
+
+    Returns:
+        str: One line per stage, counter and gauge.
+    """
+    lines = []
+    for name, summary in sorted(stats["timers"].items()):
+        lines.append(f"{name}: p50 {summary['p50 ms']:.2f} ms, p99 {summary['p99 ms']:.2f} ms, max {summary['max ms']:.1f} ms")
+    for name, value in sorted(stats["counters"].items()):
+        lines.append(f"{name}: {value}")
+    for name, gauge in sorted(stats["gauges"].items()):
+        lines.append(f"{name}: {gauge['value']:g} (max {gauge['max']:g})")
+    return "\n".join(lines)
+
+class MetricsLogger(threading.Thread):
+    """
+    A class to append a snapshot of the metrics to a log file periodically, one JSON object per line.
+    """
+
+    def __init__(self, path, interval=10.0, source=None):
+        """
+        Initializes the logger.
+
+        Args:
+            path (str): The path of the log file.
+            interval (float, optional): The time between snapshots in seconds. Defaults to 10.0.
+            source (Metrics, optional): The metrics to log. Defaults to None, which logs the shared metrics.
+        """
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.source = metrics if source is None else source
+        self._stop_event = threading.Event()
+
+    def run(self):
+        """
+        Logs a snapshot every interval until the thread is stopped.
+        """
+        while not self._stop_event.wait(self.interval):
+            self.log()
+
+    def log(self):
+        """
+        Appends the current snapshot to the log file.
+        """
+        with open(self.path, 'a') as log_file:
+            log_file.write(json.dumps(self.source.stats()) + "\n")
+
+    def stop(self):
+        """
+        Stops the thread, logging a last snapshot.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.log()
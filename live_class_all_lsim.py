@@ -2,47 +2,112 @@
 
 # Internal imports
 from config.path_config import *
-from file_handler import Data_Handler
+from config.settings import settings
+from file_handler import Data_Handler, name_handler
 from connection import *
-from reconstruction import delete_offset
+from acquisition import AcquisitionThread, MultiAcquisition
+from buffers import RingBuffer, RunningStats
+from plotting import MinMaxDecimator
+from events import EventDetector
+from instrumentation import metrics, format_stats, MetricsLogger
+from replay import ReplayDevice
+from shared_stream import SharedStreamSubscriber
+from reconstruction import delete_offset, DriftEstimator
 
 # External imports
-from scipy import signal
 import numpy as np
-import yaml
 import time
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore
 from PyQt6 import QtWidgets
+from PyQt6.QtCore import QThread, pyqtSignal
 
 import sys
 from PyQt6.QtWidgets import (QApplication, QWidget, QPushButton, QVBoxLayout, 
                              QComboBox, QSpinBox, QLabel, QLineEdit, QSizePolicy, 
                              QCheckBox)
 
+class Save_Worker(QThread):
+    """
+    A class to save a snapshot of the readings in the background, so the
+    acquisition and the plot keep running while the files are written.
+    """
+
+    progress = pyqtSignal(int, int, str)  # Finished steps, total steps and the current step
+    failed = pyqtSignal(str)
+
+    def __init__(self, file_name, description, response, reconstruction=None, events=None, channel=0):
+        """
+        Initializes the save worker.
+
+        Args:
+            file_name (str): The name of the reading.
+            description (str): Description of the reading.
+            response (numpy.ndarray): The response, one row per sample.
+            reconstruction (numpy.ndarray, optional): The reconstructed force, one row per sample. Defaults to None.
+            events (list, optional): The detected contact events. Defaults to None.
+            channel (int, optional): The channel shown in the figures. Defaults to 0.
+        """
+        super().__init__()
+        self.file_name = file_name
+        self.description = description
+        self.response = response
+        self.reconstruction = reconstruction
+        self.events = events
+        self.channel = channel
+
+    def run(self):
+        """
+        Saves the snapshot step by step, reporting the progress.
+        """
+        try:
+            # Keep earlier readings saved under the same name
+            self.file_name = name_handler(self.file_name)
+            DH = Data_Handler(self.file_name, self.response)
+            steps = [("response", DH.save_response)]
+            if self.reconstruction is not None:
+                steps.append(("reconstruction", lambda: DH.save_reconstruction(self.reconstruction)))
+                steps.append(("events", lambda: DH.save_events(self.events)))
+            steps.append(("configuration", DH.save_configuration))
+            steps.append(("figures", lambda: DH.save_figures(self.channel)))
+            # Last, as it completes the catalog entry
+            steps.append(("metadata", lambda: DH.save_metadata(self.description)))
+            for i, (name, step) in enumerate(steps):
+                self.progress.emit(i, len(steps), name)
+                # Timed apart from "save", which the file writes inside the steps already report
+                with metrics.timer("save step"):
+                    step()
+            self.progress.emit(len(steps), len(steps), "done")
+        except Exception as error:
+            self.failed.emit(str(error))
+
 class MyWindow(QWidget):
     """
     A class to create a GUI for real-time visualization of piezoelectric sensor readings.
     """
     
-    def __init__(self, reconstruct: bool):
+    def __init__(self, reconstruct: bool, boards=1, raw=False):
         """
         Initializes the GUI window and its components.
 
         Args:
             reconstruct (bool): Flag to indicate whether to perform reconstruction.
+            boards (int, optional): The number of boards acquired at once. Defaults to 1.
+            raw (bool, optional): Keep the readings as uint16 ADC codes, scaled to volts
+                only where they are used. Defaults to False.
         """
         super().__init__()  
         self.reconstruct = reconstruct  # Flag for reconstruction 0 - don't reconstruct, 1 - reconstruct
+        self.boards = boards
+        self.channels = FrameDecoder.CHANNELS * boards  # Channels of all boards, board after board
+        self.raw = raw
+        self.scale = FrameDecoder.VOLTS_PER_CODE if raw else 1.0  # Volts per value in the readings
 
-        # Load parameters from configuration file
-        with open(CONFIG_PATH + CONFIGURATION_FILE, 'r') as f:
-            data = yaml.safe_load(f)
-            for key, value in data.items():
-                setattr(self, key, value)
-        
-        self.c = self.Rf * self.Cf
-        self.tau = self.d33 / self.Cf
+        # Take the parameters from the cached configuration
+        self.setup = settings.setup
+        self.T = self.setup.T
+        self.c = self.setup.c
+        self.tau = self.setup.tau
 
         # Initialize parameters
         self.unlocked = 1  # Flag for locking the readings
@@ -50,24 +115,25 @@ class MyWindow(QWidget):
         self.additional_channels = []  # Allocation for array storing additional channels
         self.candidate_channel = 1  # The channel to be added as an additional channel
         self.roll_duration = 10000  # Length of the shown signal
-        self.offsets = np.zeros([15 + 1, 1])  # Allocation for offset data
-        self.sim_init = [0]
-
-        # Load calibration data from YAML file
-        with open(CONFIG_PATH + 'calibration_params.yaml', 'r') as file:
-            self.calibration_parameters = yaml.safe_load(file)
-        channel_no = 0
-        for entry in self.calibration_parameters['channels']:
-            self.offsets[entry["number"] - 1] = entry['offset_mean']
-            if entry["number"] == 13:
-                self.a = entry['a']
-            channel_no += 1  # Count how many channels there are in the config file
+        # Offsets, trend slopes and trend intercepts of the channels from the cached calibration
+        self.offsets, self.a, self.b = settings.calibration.vectors(self.channels)
 
         # Additional parameters for collecting data in real time
         self.sample_count = 0
-        self.force = np.array([0])
+        self.force = RingBuffer(self.channels, self.roll_duration)
         self.sample_data = [0]
-        self.reading_data = np.ones((channel_no + 1, 1)) * self.offsets
+        self.sample_position = 0  # Count of samples already taken from the acquisition buffer
+        self.reading_data = RingBuffer(self.channels, self.roll_duration, np.uint16 if raw else np.float64)
+        idle = np.round(self.offsets / self.scale) if raw else self.offsets  # Readings of the idle sensors
+        self.reading_data.append(idle)
+        # Min/max envelopes of the buffers, drawn instead of every sample
+        self.reading_envelope = MinMaxDecimator(self.channels, self.roll_duration)
+        self.reading_envelope.update(idle)
+        self.force_envelope = MinMaxDecimator(self.channels, self.roll_duration)
+        self.drift = DriftEstimator(self.channels)  # Online trend of the reconstructed force
+        self.events = EventDetector(self.channels, self.T, threshold=0.5)  # Contacts in the force [N]
+        self.force_stats = RunningStats(self.channels, int(5 * self.T))  # Noise of the detrended force
+        self.events.subscribe(self._print_event)
 
         # Customize window
         self.setWindowTitle('Piezoelectric readings')
@@ -82,7 +148,7 @@ class MyWindow(QWidget):
         self.curve = self.plot.plot(pen='g')
         self.curve2 = self.plot.plot(pen='r')
         self.curves = []
-        for i in range(16):
+        for i in range(self.channels):
             self.curves.append(self.plot.plot(pen='g'))
 
         # Create buttons
@@ -98,19 +164,27 @@ class MyWindow(QWidget):
         # Create checkbox
         self.checkbox_GT = QCheckBox('Enable GT', self)
         self.checkbox_trend = QCheckBox('Disable trend', self)
+        self.checkbox_stats = QCheckBox('Show stats', self)
         
         # Customize buttons
         self.lock_button.setCheckable(True)
 
         # Create label
         self.mean_label = QLabel("0")
+        # Pipeline statistics drawn over the plot
+        self.stats_label = QLabel(self.plot)
+        self.stats_label.setStyleSheet("background-color: rgba(0, 0, 0, 160); color: white; padding: 4px;")
+        self.stats_label.move(50, 10)
+        self.stats_label.hide()
+        self.stats_time = 0  # Time the statistics were last shown
+        self.save_failed = False  # Whether the running save reported an error
 
         # Create QLineEdit to enter a name
         self.name_edit = QLineEdit()
 
         # Create Combo list
         self.list = QComboBox()
-        self.list.addItems(['1', '2', '3','4', '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16'])
+        self.list.addItems([str(i + 1) for i in range(self.channels)])
 
         # Create Spin Box
         self.spin_box_roll = QSpinBox()
@@ -121,7 +195,7 @@ class MyWindow(QWidget):
         self.spin_box_roll.setSingleStep(10000)  # Set the increment to 1000
 
         self.spin_box_channels.setMinimum(1)  # Set minimum value (optional)
-        self.spin_box_channels.setMaximum(16)  # Set maximum value (optional)
+        self.spin_box_channels.setMaximum(self.channels)  # Set maximum value (optional)
         
         # Connect the button's clicked signal to a slot (function)
         self.reset_button.clicked.connect(self._reset_button_clicked)
@@ -135,6 +209,7 @@ class MyWindow(QWidget):
 
         self.checkbox_GT.stateChanged.connect(self.GT_state_change)
         self.checkbox_trend.stateChanged.connect(self.trend_state_change)
+        self.checkbox_stats.stateChanged.connect(self.stats_state_change)
 
         self.list.activated.connect(self._change_channel)
 
@@ -165,6 +240,7 @@ class MyWindow(QWidget):
         layout.addWidget(self.calibrate_trend_button, 12, 0)
         layout.addWidget(self.checkbox_GT, 13, 0)        
         layout.addWidget(self.checkbox_trend, 14, 0)
+        layout.addWidget(self.checkbox_stats, 16, 0)
         layout.addWidget(self.plot, 0, 1, 20, 1)
 
         # Set the layout for the main window
@@ -179,9 +255,8 @@ class MyWindow(QWidget):
 
             # Plot widget for reconstructed force
             self.plot_force = pg.PlotWidget()
-            numerator = np.array([self.Rf * self.Cf, 1])
-            denominator = np.array([self.Rf * self.d33, 0])
-            self.system = signal.lti(numerator, denominator)
+            self.system = settings.system
+            self.reconstructor = settings.reconstructor()
             self.r_curve = self.plot_force.plot(pen='g')
             layout.addWidget(self.plot_force, 0, 2, 20, 2)
             self.vb2 = self.plot_force.getViewBox()
@@ -192,8 +267,12 @@ class MyWindow(QWidget):
         """
         Resets the force values and initial values for reconstruction.
         """
-        self.force = np.zeros(np.shape(self.force))
-        self.sim_init = [0]
+        self.force.clear()
+        self.force_envelope.clear()
+        self.drift.reset()
+        self.events.reset()
+        self.force_stats.reset()
+        self.reconstructor.reset()
 
     def _reset_button_clicked(self):
         """
@@ -215,6 +294,8 @@ class MyWindow(QWidget):
     def _save_button_clicked(self):
         """
         Saves the current reading data, reconstruction, and metadata.
+
+        The buffers are copied and written by a Save_Worker in the background.
         """
         if hasattr(self, 'file_name'):
             file_name = self.file_name
@@ -222,13 +303,51 @@ class MyWindow(QWidget):
             file_name = "live_reading"
         meta_description = "Investigating the time constant for the 13th sensor"
 
-        DH = Data_Handler(file_name, np.transpose(self.reading_data))
-        DH.save_response()
-        if hasattr(self, 'force'):
-            DH.save_reconstruction(self.force)
-        DH.save_metadata(meta_description)
-        DH.save_configuration()
-        DH.save_figures(self.current_channel)
+        # Copy the buffers, as they keep changing while the files are written
+        response = np.transpose(self.reading_data.latest(self.roll_duration)).copy()
+        reconstruction, events = None, None
+        if self.reconstruct:
+            reconstruction = np.transpose(self.force.latest(self.roll_duration)).copy()
+            events = list(self.events.history)
+        self.save_worker = Save_Worker(file_name, meta_description, response, reconstruction, events, self.current_channel)
+        self.save_worker.progress.connect(self._save_progress)
+        self.save_worker.failed.connect(self._save_failed)
+        self.save_worker.finished.connect(self._save_finished)
+        self.save_button.setEnabled(False)
+        self.save_worker.start()
+
+    def _save_progress(self, done, steps, name):
+        """
+        Shows the progress of the save on the save button.
+
+        Args:
+            done (int): The number of finished steps.
+            steps (int): The total number of steps.
+            name (str): The step being saved.
+        """
+        self.save_button.setText(f"Saving {name} ({done}/{steps})")
+
+    def _save_failed(self, error):
+        """
+        Reports a failed save.
+
+        Args:
+            error (str): The error message.
+        """
+        print("Saving failed: " + error)
+        self.save_failed = True
+
+    def _save_finished(self):
+        """
+        Enables saving again once the worker has finished.
+        """
+        if self.save_failed:
+            self.save_button.setText('Save (failed)')
+        else:
+            self.save_button.setText('Save')
+            print("Readings saved to " + READINGS_DIR + self.save_worker.file_name)
+        self.save_failed = False
+        self.save_button.setEnabled(True)
 
     def _addchannels_clicked(self):
         """
@@ -251,6 +370,10 @@ class MyWindow(QWidget):
             value (int): The new roll duration.
         """
         self.roll_duration = value
+        self.reading_data.resize(value)
+        self.force.resize(value)
+        self.reading_envelope.resize(value, self.reading_data.latest(value))
+        self.force_envelope.resize(value, self.drift.detrend(self.force.latest(value)))
 
     def _candidate_channel(self, value):
         """
@@ -267,16 +390,14 @@ class MyWindow(QWidget):
         Updates the current channel for the plot.
         """
         self.current_channel = self.list.currentIndex()
-        for i in range(16):
+        for i in range(self.channels):
             self.curves[i].clear()
 
     def _mean_button_clicked(self):
         """
-        Calculates and displays the mean of the current channel's data.
+        Displays the mean of the current channel's recent readings.
         """
-        data = self.reading_data[:, -self.roll_duration:]
-        data = data[self.current_channel]
-        mean = np.mean(data)
+        mean = self.acquisition.stats.mean()[self.current_channel]
         self.mean_label.setText(str(mean))
 
     def _update_file_name(self, text):
@@ -309,104 +430,178 @@ class MyWindow(QWidget):
         """
         print(state)
 
-    def connection(self):
+    def stats_state_change(self, state):
         """
-        Establishes the connection to the piezoelectric sensor.
+        Shows or hides the pipeline statistics over the plot.
+
+        Args:
+            state (int): The state of the checkbox (checked/unchecked).
+        """
+        self.stats_label.setVisible(state == 2)
+        self.stats_time = 0
+
+    def _update_stats_overlay(self):
+        """
+        Refreshes the pipeline statistics over the plot twice per second while they are shown.
+        """
+        if self.stats_label.isVisible() and time.time() - self.stats_time > 0.5:
+            self.stats_label.setText(format_stats(metrics.stats()))
+            self.stats_label.adjustSize()
+            self.stats_time = time.time()
+
+    def _print_event(self, event):
+        """
+        Prints a detected contact while the trend checkbox is checked.
+
+        Args:
+            event (Event): The detected contact.
+        """
+        if self.checkbox_trend.isChecked():
+            print(event)
+
+    def connection(self, device=None, stream=False):
         """
-        self.piezoE_sensor = FTDI()
-        start_time = time.time()
+        Establishes the connection to the piezoelectric sensors.
+
+        Args:
+            device (optional): An opened device with the interface of FTDI, such as a
+                ReplayDevice, or a list of them with one per board. Defaults to None,
+                which opens the FTDI devices.
+            stream (bool, optional): Follow the samples published by a running
+                shared_stream.py instead of opening the devices. Defaults to False.
+        """
+        if device is None and not stream:
+            device = [FTDI(id) for id in range(self.boards)]
+        self.sensors = [] if stream else device if isinstance(device, list) else [device]
+        # Drain the devices in the background, independently of the plot updates
+        if stream:
+            self.acquisition = SharedStreamSubscriber()
+        elif len(self.sensors) == 1:
+            self.acquisition = AcquisitionThread(self.sensors[0], T=self.T, raw=self.raw)
+        else:
+            self.acquisition = MultiAcquisition(self.sensors, T=self.T, raw=self.raw)
+        # A published stream is already far ahead, take only the samples from now on
+        self.sample_position = self.acquisition.ring.count
+        self.acquisition.start()
         # Start gathering data to get a clear stream
-        while time.time() - start_time < 1:
-            pass
+        time.sleep(1)
         print("Readings beginning!")
 
-    def calibrate_offset(self):
+    def closeEvent(self, event):
         """
-        Calibrates the offset for each channel based on current readings.
+        Stops the acquisition and closes the devices when the window is closed.
+
+        Args:
+            event (QCloseEvent): The close event.
         """
-        for entry in self.calibration_parameters['channels']:
-            entry['offset_mean'] = np.mean(self.reading_data[entry["number"] - 1]).item()
+        # Let a running save finish writing its files
+        if hasattr(self, 'save_worker'):
+            self.save_worker.wait()
+        if hasattr(self, 'acquisition'):
+            self.acquisition.stop()
+            for sensor in self.sensors:
+                sensor.close()
+        super().closeEvent(event)
 
-        # Write updated data back to YAML file
-        with open(CONFIG_PATH + 'calibration_params.yaml', 'w') as file:
-            yaml.dump(self.calibration_parameters, file)
-        
-        for entry in self.calibration_parameters['channels']:
-            self.offsets[entry["number"] - 1] = entry['offset_mean']
+    def calibrate_offset(self):
+        """
+        Calibrates the offset for each channel based on the recent readings.
+        """
+        means = self.acquisition.stats.mean()
+        # Replace the calibration file atomically, the cached calibration follows it
+        calibration = settings.update_calibration(offsets=means)
+        self.offsets = calibration.vectors(self.channels)[0]
 
     def calibrate_trend(self):
         """
         Calibrates the trend for the reconstruction.
         """
         if self.reconstruct:
-            x = np.linspace(0, len(self.force), len(self.force))
-            self.a, self.b = np.polyfit(x, self.force, 1)
+            # Take the line fitted continuously to every channel
+            self.a = self.drift.slope()
+            self.b = self.drift.intercept()
             print(self.a)
-        for entry in self.calibration_parameters['channels']:
-            entry['a'] = self.a.item()
-            entry['b'] = self.b.item()
-
-        # Write updated data back to YAML file
-        with open(CONFIG_PATH + 'calibration_params.yaml', 'w') as file:
-            yaml.dump(self.calibration_parameters, file)
+            # Start contacts well above the noise of the force at rest
+            self.events.threshold = np.fmax(0.5, 6 * self.force_stats.std())[:, np.newaxis]
+            self.events.release = self.events.threshold / 2
+        # Replace the calibration file atomically, the cached calibration follows it
+        settings.update_calibration(a=self.a, b=self.b)
 
     def update_reconstruct_plot(self):
         """
         Updates the plot with reconstructed force data.
         """
-        readings = []
-        data = self.piezoE_sensor.read()
-        if data:
-            readings.extend(data)
+        start_time = time.perf_counter()
+        processed_readings, self.sample_position, dropped = self.acquisition.ring.read(self.sample_position)
+        if dropped:
+            metrics.count("samples dropped", dropped)
+        if np.size(processed_readings, 1):
             if self.unlocked:
-                readings = np.array(readings).flatten().astype(int)
-                processed_readings = process_FTDI_readings(readings)
-                self.reading_data = np.concatenate((self.reading_data, processed_readings), 1)
-                self.reading_data = self.reading_data[:, -self.roll_duration:]
-
-                processed_readings = delete_offset(processed_readings, self.offsets)
-                t = np.linspace(0, np.size(processed_readings, 1) / self.T, np.size(processed_readings, 1))
-                tout, new_force, self.sim_init = signal.lsim(self.system, processed_readings[self.current_channel, :], t, self.sim_init[-1])
-                self.force = np.concatenate((self.force, new_force))
-                self.force = self.force[-self.roll_duration:]
-                trend = np.linspace(0, len(self.force), len(self.force)) * self.a
-                if self.checkbox_trend.isChecked():
-                    print(signal.find_peaks(self.force, threshold=30))
-                self.r_curve.setData(self.force - trend)
-                self.curves[self.current_channel].setData(delete_offset(self.reading_data[self.current_channel], self.offsets[self.current_channel]))
+                self.reading_data.append(processed_readings)
+                self.reading_envelope.update(processed_readings)
+
+                processed_readings = delete_offset(processed_readings, self.offsets, self.scale)
+                # Reconstruct all channels at once, each with its own filter state
+                with metrics.timer("reconstruction"):
+                    new_force = self.reconstructor.process(processed_readings)
+                self.force.append(new_force)
+                # Update the trend and draw the force without it
+                self.drift.update(new_force)
+                new_force = self.drift.detrend(new_force)
+                self.force_envelope.update(new_force)
+                self.force_stats.update(new_force)
+                # Detect contacts in the new samples of every channel
+                self.events.process(new_force)
+                with metrics.timer("plot"):
+                    self.r_curve.setData(*self.force_envelope.curve(self.current_channel))
+                    x, reading = self.reading_envelope.curve(self.current_channel)
+                    self.curves[self.current_channel].setData(x, delete_offset(reading, self.offsets[self.current_channel], self.scale))
+        self._update_stats_overlay()
+        metrics.record("ui tick", time.perf_counter() - start_time)
 
     def update_plot(self):
         """
         Updates the plot with current sensor readings.
         """
-        readings = []
-        data = self.piezoE_sensor.read()
-        if data:
-            readings.extend(data)
+        start_time = time.perf_counter()
+        processed_readings, self.sample_position, dropped = self.acquisition.ring.read(self.sample_position)
+        if dropped:
+            metrics.count("samples dropped", dropped)
+        if np.size(processed_readings, 1):
             if self.unlocked:
-                readings = np.array(readings).flatten().astype(int)
-                processed_readings = process_FTDI_readings(readings)
-                self.reading_data = np.concatenate((self.reading_data, processed_readings), 1)
-                self.reading_data = self.reading_data[:, -self.roll_duration:]
+                self.reading_data.append(processed_readings)
+                self.reading_envelope.update(processed_readings)
 
-                self.curves[self.current_channel].setData(self.reading_data[self.current_channel])
-                for i in self.additional_channels:
-                    self.curves[i].setData(self.reading_data[i])
+                with metrics.timer("plot"):
+                    for i in [self.current_channel] + self.additional_channels:
+                        x, reading = self.reading_envelope.curve(i)
+                        self.curves[i].setData(x, reading * self.scale)
+        self._update_stats_overlay()
+        metrics.record("ui tick", time.perf_counter() - start_time)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     reconstruction = 0
+    boards = 1  # Number of boards acquired at once
+    replay = False  # Replay a synthetic signal instead of reading the boards
+    log_stats = False  # Append the pipeline statistics to a log file every 10 s
+    raw = False  # Keep the readings as 12-bit ADC codes in uint16, a quarter of the memory of volts
+    stream = False  # Follow the samples published by a running shared_stream.py instead of opening the boards
+    refresh = 16  # Milliseconds between plot updates, about 60 per second
+    device = [ReplayDevice(seed=i) for i in range(boards)] if replay else None
+    if log_stats:
+        MetricsLogger("pipeline_stats.log").start()
     if reconstruction == 0:
-        window = MyWindow(0)
-        window.connection()
+        window = MyWindow(0, boards, raw)
+        window.connection(device, stream)
         timer = QtCore.QTimer()
         timer.timeout.connect(window.update_plot)
-        timer.start(1)
+        timer.start(refresh)
     elif reconstruction == 1:
-        window = MyWindow(1)
-        window.connection()
+        window = MyWindow(1, boards, raw)
+        window.connection(device, stream)
         timer = QtCore.QTimer()
         timer.timeout.connect(window.update_reconstruct_plot)
-        timer.start(1)
+        timer.start(refresh)
     window.show()
     sys.exit(app.exec())
@@ -1,58 +1,82 @@
 # Internal imports
 from file_handler import name_handler, Data_Handler
 import matplotlib.pyplot as plt
-from config import *
+from config.path_config import *
+from config.settings import settings
 from connection import *
+from acquisition import AcquisitionThread, MultiAcquisition
+from instrumentation import metrics, format_stats, MetricsLogger
+from replay import ReplayDevice
+from shared_stream import SharedStreamSubscriber
 
 # External imports
 import pandas as pd
 import numpy as np
 import os
 import time
-import yaml
 
 if __name__ == '__main__':
     """
     Main routine for collecting and processing sensor data.
     """
-    # Allocate offset data array
-    offsets = np.zeros([16, 1])
-    
-    # Load calibration parameters from the YAML file
-    with open(CONFIG_PATH + 'calibration_params.yaml', 'r') as file:
-        calibration_parameters = yaml.safe_load(file)
-        channel_no = 0
-        for entry in calibration_parameters['channels']:
-            offsets[entry["number"] - 1] = entry['offset_mean']
+    # Take the offsets from the cached calibration
+    offsets = settings.calibration.offsets
 
     # Initialize sensor and reading parameters
-    start_time = time.time()
-    duration = 120  # Duration for data collection in seconds
-    sensor = FTDI()
-    readings = [0]
+    name = "idle2"
+    boards = 1  # Number of boards recorded at once, their channels are stored board after board
+    replay = False  # Replay a synthetic signal instead of reading the boards
+    raw = False  # Record the 12-bit ADC codes as uint16, a quarter of the size of volts
+    stream = False  # Record the samples published by a running shared_stream.py instead of opening the boards
+    duration = 120  # Duration for data collection in seconds, None records until interrupted
+    meta_description = "Experiment to validate the reconstruction. Piezosensor in the incision in skin. Sensor 13."
+
+    # Create a Data_Handler object recording the data while it is collected
+    DH = Data_Handler(name_handler(name))
+    sensors = [] if stream else [ReplayDevice(seed=i) if replay else FTDI(i) for i in range(boards)]
+    # Drain every board in its own thread, merging the boards onto one time base
+    if stream:
+        acquisition = SharedStreamSubscriber()
+    elif boards == 1:
+        acquisition = AcquisitionThread(sensors[0], raw=raw)
+    else:
+        acquisition = MultiAcquisition(sensors, raw=raw)
+    acquisition.start()
+    # Log the pipeline statistics with the recording to spot overload and lost samples
+    logger = MetricsLogger(DH.newpath + "/pipeline_stats.log")
+    logger.start()
+    position = acquisition.ring.count  # Count of samples already recorded
     print("Begin readings")
+    start_time = time.time()
     c_time = 0  # Counter for tracking time elapsed
 
-    # Collect sensor readings for the specified duration
-    while time.time() - start_time < duration:
-        data = sensor.read()
-        if data:
-            readings = np.concatenate((readings, data))
-        if time.time() - start_time > c_time:
-            print("Time: " + str(c_time) + "s")
-            c_time += 1
+    # Collect and record sensor readings for the specified duration
+    try:
+        while duration is None or time.time() - start_time < duration:
+            samples, position, dropped = acquisition.ring.read(position)
+            if dropped:
+                metrics.count("samples dropped", dropped)
+                print(f"Lost {dropped} samples")
+            if np.size(samples, 1):
+                DH.record(samples)
+            # Sleep until the acquisition stored the next block
+            acquisition.wait(0.5)
+            if time.time() - start_time > c_time:
+                print("Time: " + str(c_time) + "s")
+                c_time += 1
+    except KeyboardInterrupt:
+        print("Readings stopped")
+    finally:
+        acquisition.stop()
+        for sensor in sensors:
+            sensor.close()
+        # Record the samples that arrived since the last read
+        DH.record(acquisition.ring.read(position)[0])
+        DH.finish_recording()
+        logger.stop()
+        print(format_stats(metrics.stats()))
 
-    # Process the readings and save the data
-    name = "idle2"
-    processed_readings = process_FTDI_readings(readings[1:])
-
-    # Create a Data_Handler object for saving the data
-    DH = Data_Handler(name, np.transpose(processed_readings))
-    fs = 3124  # Sampling frequency
-    meta_description = "Experiment to validate the reconstruction. Piezosensor in the incision in skin. Sensor 13."
-    
-    # Save the response data, metadata, and configuration
-    DH.save_response()
+    # Save the metadata and configuration
     # DH.save_reconstruction(np.transpose(FE.F))  # Uncomment if reconstruction data is available
-    DH.save_metadata(meta_description)
     DH.save_configuration()
+    DH.save_metadata(meta_description)
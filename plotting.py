@@ -0,0 +1,84 @@
+# External imports
+import numpy as np
+
+# Internal imports
+from buffers import RingBuffer
+
+class MinMaxDecimator():
+    """
+    A class to reduce a rolling multi-channel signal to a min/max envelope for plotting.
+
+    The window is divided into buckets of consecutive samples and every bucket
+    is drawn as its minimum and maximum, so peaks stay visible while the number
+    of points does not depend on the window length. The envelope is updated
+    incrementally: only the new samples are reduced on every update.
+    """
+
+    def __init__(self, channels, window, points=2000):
+        """
+        Initializes the decimator.
+
+        Args:
+            channels (int): The number of channels.
+            window (int): The number of samples in the shown window.
+            points (int, optional): The largest number of buckets, about the plot width in pixels. Defaults to 2000.
+        """
+        self.channels = channels
+        self.points = points
+        self.resize(window)
+
+    def resize(self, window, samples=None):
+        """
+        Changes the window length and rebuilds the envelope.
+
+        Args:
+            window (int): The number of samples in the shown window.
+            samples (numpy.ndarray, optional): The samples currently in the window,
+                shaped (channels, samples). Defaults to None.
+        """
+        self.window = window
+        self.bucket = max(1, -(-window // self.points))  # Samples per bucket
+        buckets = -(-window // self.bucket)
+        # Interleaved minimum and maximum of every completed bucket
+        self.envelope = RingBuffer(self.channels, 2 * buckets)
+        self.partial = np.empty((self.channels, 0))  # Samples of the bucket being filled
+        self.x = np.repeat(np.arange(buckets + 1) * self.bucket, 2)
+        if samples is not None:
+            self.update(samples)
+
+    def update(self, samples):
+        """
+        Adds new samples to the envelope.
+
+        Args:
+            samples (numpy.ndarray): The new samples, shaped (channels, samples).
+        """
+        samples = np.concatenate((self.partial, samples), axis=1)
+        complete = np.size(samples, 1) // self.bucket
+        if complete:
+            buckets = samples[:, :complete * self.bucket].reshape(self.channels, complete, self.bucket)
+            pairs = np.stack((buckets.min(axis=2), buckets.max(axis=2)), axis=2)
+            self.envelope.append(pairs.reshape(self.channels, 2 * complete))
+        self.partial = samples[:, complete * self.bucket:]
+
+    def curve(self, channel):
+        """
+        Returns the points to draw for a channel.
+
+        Args:
+            channel (int): The channel.
+
+        Returns:
+            tuple: The sample positions within the window and the envelope values.
+        """
+        y = self.envelope.latest(self.envelope.capacity)[channel]
+        if np.size(self.partial, 1):
+            # Show the newest samples before their bucket is complete
+            y = np.concatenate((y, [self.partial[channel].min(), self.partial[channel].max()]))
+        return self.x[:len(y)], y
+
+    def clear(self):
+        """
+        Discards the envelope.
+        """
+        self.resize(self.window)
@@ -1,67 +1,316 @@
 # External imports
-from scipy import signal
+from scipy import signal, linalg
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import yaml
+import os
 import matplotlib.pyplot as plt
-from tqdm import tqdm
 
 # Internal imports
 from config.path_config import *
+from config.settings import settings
+from file_handler import Recording
 
-def delete_offset(data, mean):
+def delete_offset(data, mean, scale=1.0):
     """
     Deletes the offset from the data by subtracting the mean.
 
     Args:
         data (numpy.ndarray): The input data.
         mean (numpy.ndarray): The mean values to subtract.
+        scale (float, optional): The factor converting the data to the units of the mean,
+            such as the volts per ADC code for raw samples. Defaults to 1.0.
 
     Returns:
         numpy.ndarray: The data with the offset removed.
     """
+    if scale != 1.0:
+        # Scale and subtract in one pass over the raw samples
+        return np.asarray(data) * scale - mean
     data = np.array(data)
     data = data - mean
     return data
 
+def create_system(Rf, Cf, d33):
+    """
+    Creates the Laplace domain model of the sensor and its charge amplifier.
+
+    Args:
+        Rf (float): The feedback resistance.
+        Cf (float): The feedback capacitance.
+        d33 (float): The piezoelectric constant.
+
+    Returns:
+        scipy.signal.lti: The system relating the response to the force.
+    """
+    numerator = np.array([Rf * Cf, 1])
+    denominator = np.array([d33 * Rf, 0])
+    return signal.lti(numerator, denominator)
+
+class Reconstructor():
+    """
+    A class to reconstruct the force from the sensor response chunk by chunk.
+
+    The continuous system is discretized once at the sampling frequency,
+    treating the input as linear between samples exactly like signal.lsim.
+    The chunks are then filtered with a difference equation whose state
+    carries over, so the output matches a single lsim run over the whole signal.
+    """
+
+    def __init__(self, system, T):
+        """
+        Initializes the reconstructor.
+
+        Args:
+            system (scipy.signal.lti): The single-input single-output system to simulate.
+            T (float): The sampling frequency.
+        """
+        system = system.to_ss()
+        A, B, C, D = system.A, system.B, system.C, system.D
+        n = A.shape[0]
+
+        # Discretize the system for an input linear between the samples
+        M = np.zeros((n + 2, n + 2))
+        M[:n, :n] = A / T
+        M[:n, n:n + 1] = B / T
+        M[n, n + 1] = 1
+        expM = linalg.expm(M)
+        Ad = expM[:n, :n]
+        Bd1 = expM[:n, n + 1:]
+        Bd0 = expM[:n, n:n + 1] - Bd1
+
+        # Substituting w[k] = x[k] - Bd1 u[k] removes the dependence on u[k + 1]
+        numerator, self.a = signal.ss2tf(Ad, Ad @ Bd1 + Bd0, C, C @ Bd1 + D)
+        self.b = numerator[0]
+
+        # Map the system state to the state of the filter by matching the free responses
+        order = len(self.a) - 1
+        # Evolution of the filter state over one sample without input
+        self.transition = np.eye(order, k=1)
+        self.transition[:, 0] = -self.a[1:]
+        free_system = np.vstack([C @ np.linalg.matrix_power(Ad, k) for k in range(order)])
+        free_filter = np.vstack([np.linalg.matrix_power(self.transition, k)[0] for k in range(order)])
+        state_map = np.linalg.solve(free_filter, free_system)
+        # Filter state per unit of the first input for a system starting at rest
+        self.initial_state = -(state_map @ Bd1)[:, 0]
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the system to rest before the next chunk.
+        """
+        self.state = None
+
+    def process(self, chunk):
+        """
+        Reconstructs the force for the next chunk of the response.
+
+        Args:
+            chunk (numpy.ndarray): The response with the offset removed, with
+                time along the last axis.
+
+        Returns:
+            numpy.ndarray: The reconstructed force, shaped like the chunk.
+        """
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.shape[-1] == 0:
+            return chunk.copy()
+        if self.state is None:
+            self.state = chunk[..., :1] * self.initial_state
+        force, self.state = signal.lfilter(self.b, self.a, chunk, axis=-1, zi=self.state)
+        return force
+
+    def process_parallel(self, chunk, workers=None, blocks=None):
+        """
+        Reconstructs the force for a long chunk by filtering blocks of it in parallel.
+
+        The filter is linear, so every block is first filtered from rest. The
+        free response to the state left by the preceding blocks is added
+        afterwards in closed form, which makes the result equal to process up
+        to rounding. The blocks run in threads, as lfilter releases the GIL.
+
+        Args:
+            chunk (numpy.ndarray): The response with the offset removed, with
+                time along the last axis.
+            workers (int, optional): The number of threads. Defaults to the number of CPU cores.
+            blocks (int, optional): The number of blocks. Defaults to the number of threads.
+
+        Returns:
+            numpy.ndarray: The reconstructed force, shaped like the chunk.
+        """
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.shape[-1] == 0:
+            return chunk.copy()
+        if self.state is None:
+            self.state = chunk[..., :1] * self.initial_state
+        workers = workers or os.cpu_count()
+        parts = [part for part in np.array_split(chunk, blocks or workers, axis=-1) if part.shape[-1]]
+        rest = np.zeros(self.state.shape)
+
+        with ThreadPoolExecutor(workers) as executor:
+            # Filter every block from rest
+            forced = list(executor.map(lambda part: signal.lfilter(self.b, self.a, part, axis=-1, zi=rest), parts))
+        # Carry the state across the blocks, which only needs the block lengths,
+        # and add the free response to the state at the start of every block
+        for part, (force, state) in zip(parts, forced):
+            force += self._free_response(self.state, part.shape[-1])
+            self.state = state + self.state @ np.linalg.matrix_power(self.transition, part.shape[-1]).T
+        return np.concatenate([force for force, state in forced], axis=-1)
+
+    def _free_response(self, state, length):
+        """
+        Returns the output of the filter without input, starting from a given state.
+
+        Args:
+            state (numpy.ndarray): The filter state, with the state components along the last axis.
+            length (int): The number of samples.
+
+        Returns:
+            numpy.ndarray: The free response, or a constant that broadcasts to it.
+        """
+        if len(self.a) == 2:
+            # A first-order filter decays geometrically, an integrator keeps a constant offset
+            pole = -self.a[1]
+            if pole == 1:
+                return state
+            return state * pole ** np.arange(length)
+        # Responses to the unit states, shared by all channels
+        order = len(self.a) - 1
+        unit = signal.lfilter(self.b, self.a, np.zeros((order, length)), axis=-1, zi=np.eye(order))[0]
+        return state @ unit
+
+class DriftEstimator():
+    """
+    A class to track the linear drift of every channel with running least-squares sums.
+
+    Each update only touches the new samples. With a forgetting factor below
+    one, older samples lose weight exponentially and the fit follows slow
+    changes of the drift. The sums are kept relative to the newest sample,
+    which keeps them well conditioned for long recordings.
+    """
+
+    def __init__(self, channels, forgetting=1.0):
+        """
+        Initializes the estimator.
+
+        Args:
+            channels (int): The number of channels.
+            forgetting (float, optional): The weight kept by a sample per new sample,
+                1 for an ordinary least-squares fit. Defaults to 1.0.
+        """
+        self.channels = channels
+        self.forgetting = forgetting
+        self.reset()
+
+    def reset(self):
+        """
+        Discards the fit and restarts the sample count.
+        """
+        self.position = 0  # Samples seen since the reset
+        self.s0 = 0.0  # Sum of the weights
+        self.sx = 0.0  # Weighted sum of the sample positions
+        self.sxx = 0.0  # Weighted sum of the squared sample positions
+        self.sy = np.zeros(self.channels)  # Weighted sums of the values
+        self.sxy = np.zeros(self.channels)  # Weighted sums of the values times the positions
+
+    def update(self, chunk):
+        """
+        Adds new samples to the fit.
+
+        Args:
+            chunk (numpy.ndarray): The new samples, shaped (channels, samples).
+        """
+        n = np.size(chunk, 1)
+        if n == 0:
+            return
+        # Move the origin of the positions past the new samples
+        self.sxx += -2 * n * self.sx + n * n * self.s0
+        self.sx -= n * self.s0
+        self.sxy -= n * self.sy
+        # Positions of the new samples relative to the origin, and their weights
+        x = np.arange(-n, 0)
+        weights = self.forgetting ** (-x - 1.0)
+        decay = self.forgetting ** n
+        self.s0 = self.s0 * decay + weights.sum()
+        self.sx = self.sx * decay + weights @ x
+        self.sxx = self.sxx * decay + weights @ (x * x)
+        self.sy = self.sy * decay + chunk @ weights
+        self.sxy = self.sxy * decay + chunk @ (weights * x)
+        self.position += n
+
+    def slope(self):
+        """
+        Returns the fitted drift per sample.
+
+        Returns:
+            numpy.ndarray: The slope of every channel, zero before two samples were seen.
+        """
+        determinant = self.s0 * self.sxx - self.sx ** 2
+        if determinant <= 0:
+            return np.zeros(self.channels)
+        return (self.s0 * self.sxy - self.sx * self.sy) / determinant
+
+    def intercept(self):
+        """
+        Returns the fitted value at the first sample after the reset.
+
+        Returns:
+            numpy.ndarray: The intercept of every channel.
+        """
+        if self.s0 == 0:
+            return np.zeros(self.channels)
+        slope = self.slope()
+        return (self.sy - slope * self.sx) / self.s0 - slope * self.position
+
+    def detrend(self, chunk):
+        """
+        Removes the drift accumulated since the reset from the latest samples.
+
+        Only arrays of the size of the chunk are allocated.
+
+        Args:
+            chunk (numpy.ndarray): The samples ending at the newest sample, shaped (channels, samples).
+
+        Returns:
+            numpy.ndarray: The samples without the drift.
+        """
+        n = np.size(chunk, 1)
+        x = np.arange(self.position - n, self.position)
+        return chunk - self.slope()[:, np.newaxis] * x
+
 if __name__ == "__main__":
     """
     Main routine for processing sensor data and performing system reconstruction.
     """
-    # Load parameters of the system from the configuration file
-    with open(CONFIG_PATH + CONFIGURATION_FILE, 'r') as f:
-        data = yaml.safe_load(f)
-        for key, value in data.items():
-            globals()[key] = value
+    # Take the parameters of the system from the cached configuration
+    T = settings.setup.T
 
     # Create the Laplace domain system
-    numerator = np.array([Rf * Cf, 1])
-    denominator = np.array([d33 * Rf, 0])
-    system = signal.lti(numerator, denominator)
+    system = settings.system
 
     # Load the data file
     experiment_name = "tapping1"
-    data = np.genfromtxt(READINGS_DIR + experiment_name + "/output.csv", delimiter=',')
+    recording = Recording(READINGS_DIR + experiment_name + "/output")
     
-    # Adjust the data by subtracting the mean value
-    data = data[1:, :] - 1.6267545977783202
+    # Read only the analysed channel and adjust it by subtracting the mean value
+    channel = 12  # Sensor 13
+    data = recording[channel, :] - 1.6267545977783202
 
-    # Initialize variables for the reconstruction loop
+    # Perform the reconstruction in steps and collect the output
     step = 10
-    rec = []
-    t = np.linspace(0, step / T, step)
-    xout = [0]
+    reconstructor = settings.reconstructor()
+    rec = np.concatenate([reconstructor.process(data[i:i + step]) for i in range(0, len(data), step)])
 
-    # Perform the reconstruction in steps and collect the output
-    for i in tqdm(range(0, len(data), step)):
-        tout, yout, xout = signal.lsim(system, data[i:i + step], t, xout[-1])
-        rec.extend(yout)
+    # Perform the reconstruction in parallel blocks
+    reconstructor.reset()
+    rec_parallel = reconstructor.process_parallel(data)
     
     # Perform the full reconstruction for comparison
-    tout, yout, xout = signal.lsim(system, data, np.linspace(0, len(data) / T, len(data)), 0)
+    tout, yout, xout = signal.lsim(system, data, np.arange(len(data)) / T, 0)
 
     # Plot the reconstructed data
     plt.figure()
     plt.plot(rec, label='Step Reconstruction')
+    plt.plot(rec_parallel, label='Parallel Reconstruction')
     plt.plot(yout, label='Full Reconstruction')
     plt.legend()
     plt.show()
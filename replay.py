@@ -0,0 +1,279 @@
+# External imports
+import numpy as np
+import time
+
+# Internal imports
+from connection import FrameDecoder
+from instrumentation import metrics
+
+def encode_frames(codes):
+    """
+    Builds the byte stream the firmware sends for the given ADC codes.
+
+    This is the inverse of FrameDecoder.decode, before the scaling to volts.
+
+    Args:
+        codes (numpy.ndarray): The 12-bit ADC codes, shaped (16, samples).
+
+    Returns:
+        numpy.ndarray: The framed bytes.
+    """
+    codes = np.asarray(codes, dtype=np.uint16)
+    samples = np.size(codes, 1)
+    frames = np.zeros((samples, FrameDecoder.CHANNELS, FrameDecoder.PACKET_SIZE), dtype=np.uint8)
+    # Channel identifiers at bytes 0, 3 and 6 of every packet
+    frames[:, :, [0, 3, 6]] = np.arange(48).reshape(3, FrameDecoder.CHANNELS).T
+    # Undo the reordering of the output rows done by the decoder
+    packets = np.empty_like(codes)
+    packets[np.roll(np.arange(FrameDecoder.CHANNELS), -2)] = codes
+    frames[:, :, 4] = packets.T >> 8
+    frames[:, :, 5] = packets.T & 0xFF
+    return frames.reshape(-1)
+
+class Synthetic_Signal():
+    """
+    A class to generate ADC codes resembling idle sensors with occasional taps.
+    """
+
+    def __init__(self, T=3124.0, offset=1.6, noise=0.002, tap_rate=0.5, seed=0):
+        """
+        Initializes the generator.
+
+        Args:
+            T (float, optional): The sampling frequency. Defaults to 3124.0.
+            offset (float, optional): The idle level of the sensors in volts. Defaults to 1.6.
+            noise (float, optional): The standard deviation of the noise in volts. Defaults to 0.002.
+            tap_rate (float, optional): The mean number of taps per second and channel. Defaults to 0.5.
+            seed (int, optional): The seed of the random generator. Defaults to 0.
+        """
+        self.T = T
+        self.offset = offset
+        self.noise = noise
+        self.tap_rate = tap_rate
+        self.rng = np.random.default_rng(seed)
+        self.tap_shape = 0.3 * np.exp(-np.arange(int(0.05 * T)) / (0.01 * T))  # Response to a tap in volts
+        self.tail = np.zeros((FrameDecoder.CHANNELS, len(self.tap_shape)))  # Taps running into the next block
+
+    def generate(self, samples):
+        """
+        Generates the next block of samples.
+
+        Args:
+            samples (int): The number of samples per channel.
+
+        Returns:
+            numpy.ndarray: The ADC codes, shaped (16, samples).
+        """
+        taps = np.zeros((FrameDecoder.CHANNELS, samples + len(self.tap_shape)))
+        taps[:, :len(self.tap_shape)] = self.tail
+        starts = self.rng.random((FrameDecoder.CHANNELS, samples)) < self.tap_rate / self.T
+        for channel, start in zip(*np.nonzero(starts)):
+            taps[channel, start:start + len(self.tap_shape)] += self.tap_shape
+        self.tail = taps[:, samples:]
+        volts = self.offset + taps[:, :samples] + self.rng.normal(0, self.noise, (FrameDecoder.CHANNELS, samples))
+        return np.clip(np.round(volts / FrameDecoder.VOLTS_PER_CODE), 0, 4095).astype(np.uint16)
+
+class ReplayDevice():
+    """
+    A class to replay a byte stream through the same interface as FTDI.
+
+    The bytes come from a captured raw file or from a synthetic signal. They
+    become available at the sampling rate scaled by a speed factor, or all
+    at once when no speed is given. Reads can be limited to injected chunk
+    sizes and the stream can be corrupted to test the decoding.
+    """
+
+    def __init__(self, source=None, speed=1.0, chunk_size=None, corruption=0.0, dropout=0.0,
+                 loop=True, T=3124.0, seed=0):
+        """
+        Initializes the replay device.
+
+        Args:
+            source (str or numpy.ndarray, optional): The path of a raw byte file or the bytes
+                themselves. Defaults to None, which replays a synthetic signal.
+            speed (float, optional): The replay speed relative to real time, None for no
+                limit. Defaults to 1.0.
+            chunk_size (int or tuple, optional): The largest number of bytes returned by a
+                read, or the range of random read sizes. Defaults to None.
+            corruption (float, optional): The fraction of bytes replaced with random values. Defaults to 0.0.
+            dropout (float, optional): The fraction of bytes removed from the stream. Defaults to 0.0.
+            loop (bool, optional): Whether to restart a source once it ends. Defaults to True.
+            T (float, optional): The sampling frequency. Defaults to 3124.0.
+            seed (int, optional): The seed of the random generator. Defaults to 0.
+        """
+        if isinstance(source, str):
+            source = np.fromfile(source, dtype=np.uint8)
+        if source is not None and len(source) == 0:
+            # A looping empty source would never deliver the requested bytes
+            raise ValueError("The replay source holds no bytes.")
+        self.source = source
+        self.signal = Synthetic_Signal(T, seed=seed) if source is None else None
+        self.position = 0  # Position in the source
+        self.speed = speed
+        self.chunk_size = chunk_size
+        self.corruption = corruption
+        self.dropout = dropout
+        self.loop = loop
+        self.T = T
+        self.rng = np.random.default_rng(seed)
+        self.pending = np.empty(0, dtype=np.uint8)
+        self.produced = 0  # Bytes taken from the source so far
+        self.start_time = time.perf_counter()
+        self.timeout = 0.1  # Longest wait of a blocking read in seconds
+
+    def configure(self, transfer_size=None, latency=None, timeout=None):
+        """
+        Changes the read timeout. The transfer size and latency are accepted for
+        compatibility with FTDI and have no effect.
+
+        Args:
+            transfer_size (int, optional): Ignored. Defaults to None.
+            latency (int, optional): Ignored. Defaults to None.
+            timeout (float, optional): The longest wait of a blocking read in seconds.
+                Defaults to None, which keeps the current one.
+        """
+        if timeout is not None:
+            self.timeout = timeout
+
+    @classmethod
+    def from_recording(cls, path, **kwargs):
+        """
+        Creates a replay device streaming a saved response, framed as the board sends it.
+
+        Responses recorded as uint16 ADC codes replay exactly, responses in volts
+        are rounded to the nearest code.
+
+        Args:
+            path (str): The path of the recording without the extension.
+            **kwargs: The other arguments of ReplayDevice.
+
+        Returns:
+            ReplayDevice: The replay device.
+        """
+        from file_handler import Recording
+        recording = Recording(path, raw=True)
+        codes = recording[:FrameDecoder.CHANNELS, :]
+        if recording.scale is None:
+            codes = np.clip(np.round(codes / FrameDecoder.VOLTS_PER_CODE), 0, 4095)
+        if recording.T is not None:
+            kwargs.setdefault("T", recording.T)
+        return cls(encode_frames(codes), **kwargs)
+
+    def _produce(self, count):
+        """
+        Takes the next bytes from the source and corrupts them if requested.
+
+        Args:
+            count (int): The number of bytes to take.
+
+        Returns:
+            numpy.ndarray: The bytes.
+        """
+        if self.signal is not None:
+            samples = -(-count // FrameDecoder.FRAME_SIZE)
+            data = encode_frames(self.signal.generate(samples))
+        else:
+            parts = []
+            remaining = count
+            while remaining and (self.position < len(self.source) or self.loop):
+                if self.position == len(self.source):
+                    self.position = 0
+                part = self.source[self.position:self.position + remaining]
+                self.position += len(part)
+                remaining -= len(part)
+                parts.append(part)
+            data = np.concatenate(parts) if parts else np.empty(0, dtype=np.uint8)
+        self.produced += len(data)
+
+        if self.corruption:
+            damaged = np.flatnonzero(self.rng.random(len(data)) < self.corruption)
+            data[damaged] = self.rng.integers(0, 256, len(damaged))
+        if self.dropout:
+            data = data[self.rng.random(len(data)) >= self.dropout]
+        return data
+
+    def getQueueStatus(self):
+        """
+        Returns the number of bytes waiting to be read.
+
+        Returns:
+            int: The size of the backlog in bytes.
+        """
+        if self.speed is None:
+            due = self.produced + max(FrameDecoder.FRAME_SIZE * 1024 - len(self.pending), 0)
+        else:
+            elapsed = time.perf_counter() - self.start_time
+            due = int(elapsed * self.speed * self.T) * FrameDecoder.FRAME_SIZE
+        if due > self.produced:
+            self.pending = np.concatenate((self.pending, self._produce(due - self.produced)))
+        return len(self.pending)
+
+    def read(self, out=None):
+        """
+        Reads the bytes waiting in the replayed stream.
+
+        Args:
+            out (numpy.ndarray, optional): Preallocated ``uint8`` buffer to fill.
+                At most ``len(out)`` bytes are read. Defaults to None.
+
+        Returns:
+            numpy.ndarray: The received bytes, or the filled leading part of
+                ``out`` if it was supplied.
+        """
+        self.queue = self.getQueueStatus()
+        metrics.gauge("device backlog bytes", self.queue)
+        if self.chunk_size is not None:
+            if isinstance(self.chunk_size, tuple):
+                self.queue = min(self.queue, int(self.rng.integers(*self.chunk_size)))
+            else:
+                self.queue = min(self.queue, self.chunk_size)
+        if out is not None:
+            self.queue = min(self.queue, len(out))
+        read = self.pending[:self.queue]
+        self.pending = self.pending[self.queue:]
+        if out is None:
+            return read
+        out[:len(read)] = read
+        return out[:len(read)]
+
+    def read_block(self, min_bytes, out=None):
+        """
+        Waits until at least a number of bytes are due and reads them.
+
+        Args:
+            min_bytes (int): The number of bytes to wait for.
+            out (numpy.ndarray, optional): Preallocated ``uint8`` buffer to fill.
+                At most ``len(out)`` bytes are read. Defaults to None.
+
+        Returns:
+            numpy.ndarray: The received bytes, fewer than ``min_bytes`` if the
+                timeout passed, or the filled leading part of ``out``.
+        """
+        if self.speed is not None:
+            # Sleep until the missing bytes are due at the replay rate
+            missing = min_bytes - self.getQueueStatus()
+            if missing > 0:
+                time.sleep(min(missing / (FrameDecoder.FRAME_SIZE * self.T * self.speed), self.timeout))
+        return self.read(out)
+
+    def close(self):
+        """
+        Stops the replay.
+        """
+        self.pending = np.empty(0, dtype=np.uint8)
+
+def capture(device, path, duration):
+    """
+    Saves the raw bytes read from a device for later replay.
+
+    Args:
+        device (FTDI): The opened device to read from.
+        path (str): The path of the raw byte file.
+        duration (float): The duration of the capture in seconds.
+    """
+    start_time = time.time()
+    with open(path, 'wb') as file:
+        while time.time() - start_time < duration:
+            data = device.read()
+            if len(data):
+                file.write(data.tobytes())
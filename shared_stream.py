@@ -0,0 +1,370 @@
+# Fan-out of the live stream to other processes on the same machine
+
+# External imports
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import os
+import secrets
+import threading
+import time
+import numpy as np
+
+# Internal imports
+from buffers import RingBuffer, RunningStats
+from acquisition import AcquisitionThread, MultiAcquisition
+from replay import ReplayDevice
+from connection import FTDI, FrameDecoder
+
+ADDRESS = ('localhost', 6061)  # Address the publisher accepts subscribers on
+KEY_FILE = os.path.join(os.path.expanduser("~"), ".piezo_stream_key")  # Key of the running publisher
+
+def write_key(path=KEY_FILE):
+    """
+    Creates a random key for a publisher and stores it for the subscribers of the same user.
+
+    Anyone holding the key can send objects the other side unpickles, so the
+    file is readable by its owner only.
+
+    Args:
+        path (str, optional): The path of the key file. Defaults to KEY_FILE.
+
+    Returns:
+        bytes: The key.
+    """
+    key = secrets.token_bytes(32)
+    if os.path.exists(path):
+        os.remove(path)
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(descriptor, 'wb') as key_file:
+        key_file.write(key)
+    return key
+
+def read_key(path=KEY_FILE):
+    """
+    Reads the key of the running publisher.
+
+    Args:
+        path (str, optional): The path of the key file. Defaults to KEY_FILE.
+
+    Returns:
+        bytes: The key.
+    """
+    with open(path, 'rb') as key_file:
+        return key_file.read()
+
+class SharedRingBuffer(RingBuffer):
+    """
+    A class to hold a RingBuffer in shared memory, so other processes can
+    read the samples without copying them.
+
+    The sample counter and the number of valid samples are stored in a
+    header in front of the samples. The counter doubles as the sequence
+    number of the samples: the sample with number n is overwritten once the
+    counter reaches n + capacity.
+    """
+
+    HEADER = 8  # Number of int64 values in front of the samples
+
+    def __init__(self, channels, capacity, name=None, dtype=np.float64):
+        """
+        Creates the shared ring buffer, or attaches to an existing one.
+
+        Args:
+            channels (int): The number of channels.
+            capacity (int): The number of samples held per channel.
+            name (str, optional): The name of an existing shared memory block to attach to.
+                Defaults to None, which creates a new one.
+            dtype (numpy.dtype, optional): The type of the samples. Defaults to numpy.float64.
+        """
+        self.channels = channels
+        self.capacity = capacity
+        size = self.HEADER * 8 + channels * 2 * capacity * np.dtype(dtype).itemsize
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            # Only the creator may remove the block when its process exits
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+            self.owner = False
+        self.name = self.memory.name
+        self.header = np.ndarray(self.HEADER, dtype=np.int64, buffer=self.memory.buf)
+        self.data = np.ndarray((channels, 2 * capacity), dtype=dtype, buffer=self.memory.buf, offset=self.HEADER * 8)
+        if self.owner:
+            self.header[:] = 0
+
+    @property
+    def count(self):
+        return int(self.header[0])
+
+    @count.setter
+    def count(self, value):
+        self.header[0] = value
+
+    @property
+    def size(self):
+        return int(self.header[1])
+
+    @size.setter
+    def size(self, value):
+        self.header[1] = value
+
+    def resize(self, capacity):
+        """
+        Shared ring buffers keep their size, as other processes map the memory.
+        """
+        raise RuntimeError("A shared ring buffer cannot be resized, as other processes map its memory.")
+
+    def close(self):
+        """
+        Detaches from the shared memory and removes it if this process created it.
+        """
+        # Drop the views before the memory is unmapped
+        self.header = None
+        self.data = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+class SharedStreamPublisher(threading.Thread):
+    """
+    A class to publish decoded samples to other processes.
+
+    The samples are written to a SharedRingBuffer. Subscribers connect over a
+    local socket, receive the metadata of the stream and are notified of the
+    sample counter as new samples arrive. The thread sends the notifications.
+    """
+
+    def __init__(self, channels, capacity=2**16, T=3124.0, address=ADDRESS, authkey=None, interval=0.005,
+                 raw=False):
+        """
+        Initializes the publisher and starts accepting subscribers.
+
+        Args:
+            channels (int): The number of channels.
+            capacity (int, optional): The number of samples held in the shared ring buffer. Defaults to 2**16.
+            T (float, optional): The sampling frequency. Defaults to 3124.0.
+            address (tuple, optional): The address subscribers connect to. Defaults to ADDRESS.
+            authkey (bytes, optional): The key subscribers authenticate with. Defaults to None,
+                which creates a random key and stores it in KEY_FILE for the subscribers.
+            interval (float, optional): The time between notifications in seconds. Defaults to 0.005.
+            raw (bool, optional): Publish the uint16 ADC codes instead of volts. Defaults to False.
+        """
+        super().__init__(daemon=True)
+        self.ring = SharedRingBuffer(channels, capacity, dtype=np.uint16 if raw else np.float64)
+        self.metadata = {"shared memory": self.ring.name, "channels": channels, "capacity": capacity, "T": T,
+                         "dtype": self.ring.data.dtype.str, "scale": FrameDecoder.VOLTS_PER_CODE if raw else 1.0}
+        self.interval = interval
+        self.key_file = None  # Key file to remove when the stream ends
+        if authkey is None:
+            authkey = write_key()
+            self.key_file = KEY_FILE
+        self.listener = Listener(address, authkey=authkey)
+        self.clients = []
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        """
+        Sends the metadata to every new subscriber and adds it to the notified clients.
+        """
+        while not self._stop_event.is_set():
+            try:
+                # A client with a wrong key is refused, its socket is closed with the failed connection
+                client = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue
+            try:
+                client.send(self.metadata)
+            except (OSError, EOFError):
+                client.close()
+                continue
+            with self.lock:
+                self.clients.append(client)
+
+    def notify(self, message):
+        """
+        Sends a message to all subscribers, dropping the ones that disconnected.
+
+        Args:
+            message (dict): The message.
+        """
+        with self.lock:
+            for client in list(self.clients):
+                try:
+                    client.send(message)
+                except (OSError, EOFError):
+                    client.close()
+                    self.clients.remove(client)
+
+    def run(self):
+        """
+        Notifies the subscribers of the sample counter until the thread is stopped.
+        """
+        count = 0
+        while not self._stop_event.wait(self.interval):
+            if self.ring.count != count:
+                count = self.ring.count
+                self.notify({"count": count, "time": time.time()})
+
+    def stop(self):
+        """
+        Tells the subscribers that the stream ended and removes the shared memory and the key file.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.notify({"closed": True})
+        self.listener.close()
+        with self.lock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+        self.ring.close()
+        if self.key_file is not None and os.path.exists(self.key_file):
+            os.remove(self.key_file)
+
+class SharedStreamSubscriber(threading.Thread):
+    """
+    A class to follow a published stream from another process.
+
+    It offers the same ring buffer and running statistics as an
+    AcquisitionThread, so it can replace the acquisition in the live window
+    or in main.py. The ring buffer maps the publisher's memory: latest and
+    view return samples without copying them, and fell_behind tells whether
+    the publisher has overwritten them since.
+    """
+
+    def __init__(self, address=ADDRESS, authkey=None, stats_window=2**14, timeout=5.0):
+        """
+        Connects to a publisher and attaches to its shared memory.
+
+        Args:
+            address (tuple, optional): The address of the publisher. Defaults to ADDRESS.
+            authkey (bytes, optional): The key to authenticate with. Defaults to None,
+                which reads the key of the running publisher from KEY_FILE.
+            stats_window (int, optional): The number of recent samples in the windowed statistics. Defaults to 2**14.
+            timeout (float, optional): The longest wait for the metadata of the stream in seconds. Defaults to 5.0.
+        """
+        super().__init__(daemon=True)
+        self.connection = Client(address, authkey=read_key() if authkey is None else authkey)
+        if not self.connection.poll(timeout):
+            self.connection.close()
+            raise TimeoutError("The publisher did not send the stream metadata.")
+        self.metadata = self.connection.recv()
+        self.channels = self.metadata["channels"]
+        self.T = self.metadata["T"]
+        self.scale = self.metadata["scale"]  # Volts per value in the ring buffer
+        self.ring = SharedRingBuffer(self.channels, self.metadata["capacity"], name=self.metadata["shared memory"],
+                                     dtype=self.metadata["dtype"])
+        self.stats = RunningStats(self.channels, stats_window, scale=self.scale)
+        self.position = self.ring.count  # Sample counter of the statistics
+        self.closed = False  # Whether the publisher ended the stream
+        self.dropped = 0  # Samples overwritten before the statistics took them
+        self._new_samples = threading.Event()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        """
+        Receives the notifications and updates the statistics until the thread is stopped.
+        """
+        while not self._stop_event.is_set() and not self.closed:
+            try:
+                if not self.connection.poll(0.05):
+                    continue
+                message = self.connection.recv()
+            except (OSError, EOFError):
+                message = {"closed": True}
+            if message.get("closed"):
+                self.closed = True
+            else:
+                samples, self.position, dropped = self.ring.read(self.position)
+                self.dropped += dropped
+                self.stats.update(samples)
+            self._new_samples.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for new samples or the end of the stream.
+
+        Args:
+            timeout (float, optional): The longest wait in seconds. Defaults to None.
+
+        Returns:
+            bool: True if new samples arrived or the stream ended.
+        """
+        arrived = self._new_samples.wait(timeout)
+        self._new_samples.clear()
+        return arrived
+
+    def view(self, since):
+        """
+        Returns the samples written after a given sample count without copying them.
+
+        Args:
+            since (int): The sample count returned by the previous view or read.
+
+        Returns:
+            tuple: A view of the new samples shaped (channels, samples), the current
+                sample count and the number of samples already overwritten.
+        """
+        # The counter is read once, the publisher may advance it meanwhile
+        count = self.ring.count
+        dropped = max(count - since - min(count, self.ring.capacity), 0)
+        end = count % self.ring.capacity + self.ring.capacity
+        return self.ring.data[:, end - (count - since - dropped):end], count, dropped
+
+    def fell_behind(self, since):
+        """
+        Checks whether samples were overwritten while they were in use.
+
+        Args:
+            since (int): The sample count of the first sample in use.
+
+        Returns:
+            bool: True if the publisher has overwritten the sample.
+        """
+        return self.ring.count - since > self.ring.capacity
+
+    def stop(self):
+        """
+        Stops following the stream. The samples stay readable until close is called.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.connection.close()
+
+    def close(self):
+        """
+        Detaches from the shared memory.
+        """
+        self.ring.close()
+
+if __name__ == '__main__':
+    # Acquire from the boards and publish the samples to the local subscribers
+    boards = 1  # Number of boards acquired at once
+    replay = False  # Replay a synthetic signal instead of reading the boards
+    raw = False  # Publish the 12-bit ADC codes as uint16 instead of volts
+
+    sensors = [ReplayDevice(seed=i) if replay else FTDI(i) for i in range(boards)]
+    publisher = SharedStreamPublisher(16 * boards, raw=raw)
+    if boards == 1:
+        acquisition = AcquisitionThread(sensors[0], ring=publisher.ring, raw=raw)
+    else:
+        acquisition = MultiAcquisition(sensors, ring=publisher.ring, raw=raw)
+    publisher.start()
+    acquisition.start()
+    print(f"Publishing {16 * boards} channels on {ADDRESS[0]}:{ADDRESS[1]}, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Publishing stopped")
+    finally:
+        acquisition.stop()
+        for sensor in sensors:
+            sensor.close()
+        publisher.stop()